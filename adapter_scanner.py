@@ -0,0 +1,110 @@
+"""
+BLE scanning on one or several local HCI adapters, with each device served by its best adapter
+"""
+import logging
+import time
+from typing import Callable, Dict, List, Optional
+
+from bleak import BleakScanner
+from victron_ble.scanner import BaseScanner
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class RawScanner(BaseScanner):
+    """Reports every new Victron instant-readout advertisement with its RSSI; needs no keys"""
+
+    def __init__(self, on_frame: Callable[[str, int, bytes], None], adapter: Optional[str] = None):
+        # Not calling BaseScanner.__init__: it always builds a scanner on the default adapter
+        self.adapter = adapter
+        self.on_frame = on_frame
+        options = {'bluez': {'adapter': adapter}} if adapter else {}
+        self._scanner = BleakScanner(detection_callback=self._detection_callback, **options)
+        # Last frame per address, bounded by the Victron devices in radio range
+        self._last: Dict[str, bytes] = {}
+
+    def _detection_callback(self, device, advertisement):
+        data = advertisement.manufacturer_data.get(0x02E1)
+        if not data or not data.startswith(b"\x10") or self._last.get(device.address) == data:
+            return
+        self._last[device.address] = data
+        self.on_frame(device.address, advertisement.rssi, data)
+
+
+class _AdapterStats:
+    __slots__ = ('rssi', 'last_seen')
+
+    def __init__(self, rssi: float, now: float):
+        self.rssi = rssi
+        self.last_seen = now
+
+
+class MultiAdapterScanner:
+    """Scans on several adapters and merges their streams.
+
+    Every adapter hears every device, so each device is assigned to the
+    adapter with the best smoothed RSSI and copies from the others are
+    dropped before decryption. A device moves when another adapter beats its
+    adapter by `hysteresis` dB, or when its adapter has not heard it for
+    `failover_after` seconds (e.g. the adapter stopped producing).
+    """
+
+    def __init__(self, adapters: List[str], on_advertisement: Callable[[str, int, bytes], None],
+                 failover_after: float = 30.0, hysteresis: float = 6.0, smoothing: float = 0.3):
+        self.adapters = adapters
+        self.on_advertisement = on_advertisement
+        self.failover_after = failover_after
+        self.hysteresis = hysteresis
+        self.smoothing = smoothing
+        self.assigned: Dict[str, str] = {}
+        self._stats: Dict[str, Dict[str, _AdapterStats]] = {}
+        self._scanners: List[RawScanner] = []
+
+    async def start(self):
+        for adapter in self.adapters:
+            scanner = RawScanner(lambda address, rssi, data, adapter=adapter: self._on_frame(adapter, address, rssi, data),
+                                 adapter)
+            try:
+                await scanner.start()
+            except Exception as e:
+                logger.error(f"Could not start scanning on {adapter}: {e}")
+                continue
+            self._scanners.append(scanner)
+            logger.info(f"Scanning on {adapter}")
+        if not self._scanners:
+            raise RuntimeError(f"No BLE adapter could be started ({', '.join(self.adapters)})")
+
+    async def stop(self):
+        for scanner in self._scanners:
+            try:
+                await scanner.stop()
+            except Exception as e:
+                logger.error(f"Error stopping scanner on {scanner.adapter}: {e}")
+        self._scanners = []
+
+    def _on_frame(self, adapter: str, address: str, rssi: int, data: bytes, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        per_adapter = self._stats.setdefault(address, {})
+        stats = per_adapter.get(adapter)
+        if stats is None:
+            stats = per_adapter[adapter] = _AdapterStats(rssi, now)
+        else:
+            stats.rssi += self.smoothing * (rssi - stats.rssi)
+            stats.last_seen = now
+
+        assigned = self.assigned.get(address)
+        if assigned != adapter:
+            current = per_adapter.get(assigned) if assigned else None
+            if current is None:
+                logger.info(f"Assigned {address} to {adapter} ({rssi} dBm)")
+            elif now - current.last_seen > self.failover_after:
+                logger.warning(f"{assigned} has not heard {address} for {now - current.last_seen:.0f}s, moving it to {adapter}")
+                metrics.ADAPTER_FAILOVERS.inc()
+            elif stats.rssi > current.rssi + self.hysteresis:
+                logger.info(f"Moving {address} from {assigned} ({current.rssi:.0f} dBm) to {adapter} ({stats.rssi:.0f} dBm)")
+            else:
+                return
+            self.assigned[address] = adapter
+        self.on_advertisement(address, rssi, data)
@@ -0,0 +1,100 @@
+"""
+Tumbling-window aggregation of readings (min/max/mean/last/count per numeric field)
+"""
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+
+class FieldStats:
+    __slots__ = ('min', 'max', 'total', 'count', 'last')
+
+    def __init__(self, value: float):
+        self.min = self.max = self.last = value
+        self.total = value
+        self.count = 1
+
+    def add(self, value: float):
+        if value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+        self.total += value
+        self.last = value
+        self.count += 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'min': self.min,
+            'max': self.max,
+            'mean': round(self.total / self.count, 4),
+            'last': self.last,
+            'count': self.count,
+        }
+
+
+class Window:
+    __slots__ = ('start', 'samples', 'stats', 'latest')
+
+    def __init__(self, start: float):
+        self.start = start
+        self.samples = 0
+        self.stats: Dict[str, FieldStats] = {}
+        self.latest: Dict[str, Any] = {}
+
+
+class TumblingAggregator:
+    """Per-device windows aligned to multiples of the window length.
+
+    Memory is one FieldStats per numeric field per device, whatever the
+    sample rate. A window is closed by the first reading past its end, or
+    by expire() when a device goes quiet.
+    """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._windows: Dict[str, Window] = {}
+
+    def add(self, key: str, data: Dict[str, Any], timestamp: float) -> Optional[Dict[str, Any]]:
+        """Add a reading; returns the summary of the window it closed, if any"""
+        closed = None
+        current = self._windows.get(key)
+        if current is not None and timestamp >= current.start + self.window:
+            closed = self._summarize(current)
+            current = None
+        if current is None:
+            current = self._windows[key] = Window(timestamp - timestamp % self.window)
+
+        current.samples += 1
+        current.latest = data
+        stats = current.stats
+        for field, value in data.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                field_stats = stats.get(field)
+                if field_stats is None:
+                    stats[field] = FieldStats(value)
+                else:
+                    field_stats.add(value)
+        return closed
+
+    def expire(self, now: float) -> List[Tuple[str, Dict[str, Any]]]:
+        """Close every window that ended before now"""
+        expired = []
+        for key, window in list(self._windows.items()):
+            if now >= window.start + self.window:
+                expired.append((key, self._summarize(window)))
+                del self._windows[key]
+        return expired
+
+    def _summarize(self, window: Window) -> Dict[str, Any]:
+        fields = {field: stats.summary() for field, stats in window.stats.items()}
+        # Non-numeric fields (states, model name) only carry their last value
+        for field, value in window.latest.items():
+            if field not in fields and field != 'timestamp' and value is not None:
+                fields[field] = {'last': value}
+        return {
+            'window_start': datetime.fromtimestamp(window.start).isoformat(),
+            'window_end': datetime.fromtimestamp(window.start + self.window).isoformat(),
+            'samples': window.samples,
+            'fields': fields,
+            'latest': window.latest,
+        }
@@ -0,0 +1,28 @@
+"""
+Jittered exponential backoff for reconnect and restart loops
+"""
+import random
+
+
+class JitteredBackoff:
+    """Delays of initial * factor**n, capped at maximum, each shortened by a random share of up to jitter.
+
+    The jitter keeps gateways that lost the same broker or BlueZ instance
+    from retrying in lockstep. reset() after a success starts over at initial.
+    """
+
+    def __init__(self, initial: float = 0.5, maximum: float = 60.0, factor: float = 2.0, jitter: float = 0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self) -> float:
+        delay = min(self.maximum, self.initial * self.factor ** self.attempts)
+        if delay < self.maximum:
+            self.attempts += 1
+        return delay * (1 - random.uniform(0, self.jitter))
+
+    def reset(self):
+        self.attempts = 0
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+"""
+Benchmark of the decode -> dict -> serialize -> publish hot path.
+
+Feeds synthetic (or captured) advertisements through VictronMPPTReader
+against the in-process LocalBroker and reports per-stage latency
+percentiles, readings/s, memory per reading and peak RSS for 1, 10 and
+100 simulated devices. Each device count runs in its own process so peak
+RSS is not inherited between scenarios.
+
+    python benchmark.py                     # run and print results
+    python benchmark.py --save-baseline     # record results for this machine
+    python benchmark.py --compare           # exit 1 if slower than the baseline
+
+Baselines are stored per machine type (platform.machine()) in
+benchmark_baseline.json, so a Raspberry Pi compares against Pi numbers.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+
+from readings import iso_timestamp
+
+logger = logging.getLogger(__name__)
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+DELIVERY_READINGS = 500  # Readings timed one at a time for broker_delivery
+DEVICE_COUNTS = (1, 10, 100)
+SOLAR_CHARGER_MODEL = 0xA060
+SOLAR_CHARGER_MODE = 0x01
+
+# Scenario-level metrics where a larger value is a regression; readings_per_s is the reverse
+MEMORY_METRICS = ('peak_kib_per_reading', 'retained_blocks_per_reading', 'peak_rss_kib')
+LATENCY_METRICS = ('p50_us', 'p95_us', 'p99_us')
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pick(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1e6, 1)
+    return {'p50_us': pick(0.50), 'p95_us': pick(0.95), 'p99_us': pick(0.99), 'count': len(ordered)}
+
+
+def solar_charger_advertisement(key: bytes, iv: int, charge_state: int, battery_voltage: float,
+                                battery_current: float, yield_today: int, solar_power: int,
+                                load_current: float) -> bytes:
+    """Encrypted SolarCharger manufacturer data, laid out as victron_ble parses it"""
+    fields = [
+        (charge_state, 8),
+        (0, 8),  # charger_error
+        (round(battery_voltage * 100), 16),
+        (round(battery_current * 10), 16),
+        (yield_today // 10, 16),
+        (solar_power, 16),
+        (round(load_current * 10), 9),
+    ]
+    # Bit fields are packed LSB first
+    packed = offset = 0
+    for value, width in fields:
+        packed |= (value & ((1 << width) - 1)) << offset
+        offset += width
+    plaintext = packed.to_bytes((offset + 7) // 8, 'little')
+    cipher = AES.new(key, AES.MODE_CTR, counter=Counter.new(128, initial_value=iv, little_endian=True))
+    header = struct.pack('<HHBH', 0x0010, SOLAR_CHARGER_MODEL, SOLAR_CHARGER_MODE, iv)
+    return header + key[:1] + cipher.encrypt(plaintext)
+
+
+def synthetic_advertisements(devices: List[Tuple[str, bytes]], readings: int,
+                             seed: int = 1) -> List[Tuple[float, str, bytes]]:
+    """Round-robin readings with slowly wandering values, one per device per second"""
+    rng = random.Random(seed)
+    state = {address: [13.2, 4.0, 0, 60] for address, _ in devices}
+    start = time.time() - readings / len(devices)
+    result = []
+    for index in range(readings):
+        address, key = devices[index % len(devices)]
+        values = state[address]
+        values[0] = min(14.6, max(12.0, values[0] + rng.uniform(-0.02, 0.02)))
+        values[1] = min(20.0, max(0.0, values[1] + rng.uniform(-0.3, 0.3)))
+        values[2] += rng.choice((0, 0, 0, 10))
+        values[3] = max(0, int(values[1] * values[0]) + rng.randint(-2, 2))
+        raw = solar_charger_advertisement(key, (index * 7919) & 0xffff, 3, values[0], values[1],
+                                          values[2], values[3], 0.0)
+        result.append((start + index / len(devices), address, raw))
+    return result
+
+
+def synthetic_devices(count: int) -> List[Tuple[str, bytes]]:
+    rng = random.Random(count)
+    return [(':'.join(f"{byte:02X}" for byte in (0xDE, 0xC0, 0xDE, n >> 16 & 0xff, n >> 8 & 0xff, n & 0xff)),
+             bytes(rng.randrange(256) for _ in range(16)))
+            for n in range(1, count + 1)]
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def wrap(self, stage: str, func: Callable) -> Callable:
+        samples = self.samples.setdefault(stage, [])
+        clock = time.perf_counter
+        if asyncio.iscoroutinefunction(func):
+            async def timed_async(*args, **kwargs):
+                started = clock()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    samples.append(clock() - started)
+            return timed_async
+
+        def timed(*args, **kwargs):
+            started = clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                samples.append(clock() - started)
+        return timed
+
+
+async def run_scenario(advertisements: List[Tuple[float, str, bytes]], devices_config: str) -> Dict[str, Any]:
+    """Push the advertisements through a reader wired to a local broker and measure each stage"""
+    import main
+    from local_broker import LocalBroker
+
+    broker = LocalBroker()
+    port = await broker.start()
+    os.environ.update({
+        'DEVICES_CONFIG': devices_config,
+        'MQTT_HOST': '127.0.0.1',
+        'MQTT_PORT': str(port),
+        'MQTT_USER': os.getenv('MQTT_USER') or 'benchmark',
+        'MQTT_PASSWORD': os.getenv('MQTT_PASSWORD') or 'benchmark',
+        'OFFLINE_QUEUE_DIR': '',
+    })
+    for name in ('CAPTURE_FILE', 'REPLAY_FILE', 'TIMESERIES_DIR', 'AGGREGATION_WINDOW'):
+        os.environ.pop(name, None)
+
+    reader = main.VictronMPPTReader()
+    reader.setup_mqtt()
+    await asyncio.wait_for(reader.publisher.connected.wait(), 10)
+
+    matched = [ad for ad in (reader.match_advertisement(address, raw, received_at)
+                             for received_at, address, raw in advertisements) if ad]
+    if not matched:
+        raise RuntimeError("No advertisement matched the configured devices")
+
+    timer = StageTimer()
+    for config in reader.registry:
+        if config.device:
+            config.device.parse = timer.wrap('decode', config.device.parse)
+    main.extract_reading = timer.wrap('extract', main.extract_reading)
+    reader.read_mppt_data = timer.wrap('read_mppt_data', reader.read_mppt_data)
+    reader.publish_discovery = timer.wrap('publish_discovery', reader.publish_discovery)
+    reader.publish_to_mqtt = timer.wrap('publish_to_mqtt', reader.publish_to_mqtt)
+    process = timer.wrap('process_advertisement', reader.process_advertisement)
+
+    blocks_before = sys.getallocatedblocks()
+    started = time.perf_counter()
+    for ad in matched:
+        await process(ad)
+        await reader.publisher.wait_writable()
+    await reader.publisher.flush(60)
+    elapsed = time.perf_counter() - started
+    messages = broker.messages_received
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+    stages = {stage: percentiles(samples) for stage, samples in timer.samples.items()}
+
+    # Delivery latency, from the start of processing to the broker receiving the reading's /all. Measured
+    # one reading at a time: in the pass above it is dominated by the backlog the producer builds up
+    pending: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def on_message(topic: str, payload: bytes, retain: bool):
+        if topic.endswith('/all'):
+            future = pending.pop((topic[:-4], json.loads(payload)['timestamp']), None)
+            if future and not future.done():
+                future.set_result(time.perf_counter())
+    broker.add_hook(on_message)
+
+    delivery = []
+    loop = asyncio.get_running_loop()
+    for ad in matched[:DELIVERY_READINGS]:
+        key = (reader.registry.lookup(ad.address).topic_prefix, iso_timestamp(int(ad.received_at * 1000)))
+        pending[key] = received = loop.create_future()
+        sent = time.perf_counter()
+        await reader.process_advertisement(ad)
+        try:
+            delivery.append(await asyncio.wait_for(received, 1) - sent)
+        except asyncio.TimeoutError:
+            pending.pop(key, None)
+    stages['broker_delivery'] = percentiles(delivery)
+
+    # Serialization of the complete reading, measured apart from the queueing around it
+    readings = [data for data in [await reader.read_mppt_data(ad) for ad in matched[:1000]] if data]
+    serialize = []
+    for data in readings:
+        t = time.perf_counter()
+        data.to_json()
+        serialize.append(time.perf_counter() - t)
+
+    # Transient memory per reading, traced separately because tracemalloc slows everything down
+    tracemalloc.start()
+    peaks = []
+    for ad in matched[:200]:
+        tracemalloc.reset_peak()
+        baseline, _ = tracemalloc.get_traced_memory()
+        await reader.process_advertisement(ad)
+        peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    await reader.publisher.flush(60)
+
+    stages['serialize_json'] = percentiles(serialize)
+    result = {
+        'devices': len(reader.registry),
+        'readings': len(matched),
+        'readings_per_s': round(len(matched) / elapsed, 1),
+        'mqtt_messages_per_s': round(messages / elapsed, 1),
+        'messages_per_reading': round(messages / len(matched), 2),
+        'dropped': reader.publisher.dropped,
+        'peak_kib_per_reading': round(sum(peaks) / len(peaks) / 1024, 2),
+        'retained_blocks_per_reading': round(retained_blocks / len(matched), 2),
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'stages': stages,
+    }
+    await reader.publisher.stop()
+    await broker.stop()
+    return result
+
+
+def scenario_main(args: argparse.Namespace) -> Dict[str, Any]:
+    """Entry point of the per-scenario child process"""
+    if args.capture:
+        from capture import read_capture
+        advertisements = list(read_capture(args.capture))
+        devices_config = os.environ['DEVICES_CONFIG']
+        return asyncio.run(run_scenario(advertisements, devices_config))
+
+    devices = synthetic_devices(args.scenario)
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump([{'address': address, 'key': key.hex(), 'name': f"Bench {n}"}
+                   for n, (address, key) in enumerate(devices, 1)], f)
+    try:
+        advertisements = synthetic_advertisements(devices, max(args.readings, len(devices)))
+        return asyncio.run(run_scenario(advertisements, f.name))
+    finally:
+        os.unlink(f.name)
+
+
+def run_in_child(args: argparse.Namespace, devices: int) -> Dict[str, Any]:
+    command = [sys.executable, os.path.abspath(__file__), '--scenario', str(devices),
+               '--readings', str(args.readings), '--log-level', args.log_level]
+    if args.capture:
+        command += ['--capture', args.capture]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise RuntimeError(f"Scenario with {devices} devices failed:\n{completed.stderr}")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def compare(results: Dict[str, Dict[str, Any]], baseline: Dict[str, Dict[str, Any]],
+            tolerance: float) -> List[str]:
+    """Human-readable regressions of results against baseline beyond tolerance (0.2 = 20%)"""
+    regressions = []
+
+    def check(name: str, current: Optional[float], reference: Optional[float], lower_is_better: bool):
+        if not current or not reference:
+            return
+        change = (current - reference) / reference
+        if (change > tolerance) if lower_is_better else (-change > tolerance):
+            regressions.append(f"{name}: {reference} -> {current} ({change:+.0%})")
+
+    for scenario, result in results.items():
+        reference = baseline.get(scenario)
+        if not reference:
+            continue
+        check(f"{scenario} readings_per_s", result['readings_per_s'], reference['readings_per_s'], False)
+        for metric in MEMORY_METRICS:
+            check(f"{scenario} {metric}", result[metric], reference[metric], True)
+        for stage, stats in result['stages'].items():
+            for metric in LATENCY_METRICS:
+                check(f"{scenario} {stage} {metric}", stats.get(metric),
+                      reference['stages'].get(stage, {}).get(metric), True)
+    return regressions
+
+
+def print_results(results: Dict[str, Dict[str, Any]]):
+    for scenario, result in results.items():
+        print(f"\n== {scenario}: {result['devices']} devices, {result['readings']} readings ==")
+        print(f"  {result['readings_per_s']:.0f} readings/s, {result['mqtt_messages_per_s']:.0f} MQTT msg/s "
+              f"({result['messages_per_reading']} per reading, {result['dropped']} dropped)")
+        print(f"  {result['peak_kib_per_reading']} KiB transient and {result['retained_blocks_per_reading']} "
+              f"retained blocks per reading, peak RSS {result['peak_rss_kib'] / 1024:.1f} MiB")
+        print(f"  {'stage':<22} {'p50 us':>9} {'p95 us':>9} {'p99 us':>9} {'count':>8}")
+        for stage, stats in result['stages'].items():
+            if stats:
+                print(f"  {stage:<22} {stats['p50_us']:>9} {stats['p95_us']:>9} {stats['p99_us']:>9} {stats['count']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--devices', type=int, nargs='+', default=list(DEVICE_COUNTS),
+                        help="Simulated device counts (default: 1 10 100)")
+    parser.add_argument('--readings', type=int, default=5000, help="Readings per scenario (default: 5000)")
+    parser.add_argument('--capture', help="Replay this capture file instead of synthetic data "
+                                          "(device keys come from DEVICES_CONFIG)")
+    parser.add_argument('--save-baseline', action='store_true', help="Store the results as this machine's baseline")
+    parser.add_argument('--compare', action='store_true', help="Exit 1 on a regression against the baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed regression (default: 0.25 = 25%%)")
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    parser.add_argument('--log-level', default='WARNING', help="Log level while benchmarking (default: WARNING)")
+    parser.add_argument('--scenario', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario is not None:
+        logging.basicConfig(level=args.log_level.upper())
+        print(json.dumps(scenario_main(args)))
+        return
+
+    counts = ['capture'] if args.capture else args.devices
+    results = {}
+    for count in counts:
+        name = 'capture' if args.capture else f"devices_{count}"
+        logger.info(f"Running {name}")
+        results[name] = run_in_child(args, 0 if args.capture else count)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+    machine = platform.machine() or 'unknown'
+    baselines: Dict[str, Any] = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)
+
+    if args.save_baseline:
+        baselines[machine] = {
+            'python': platform.python_version(),
+            'recorded': time.strftime('%Y-%m-%d'),
+            'results': {**baselines.get(machine, {}).get('results', {}), **results},
+        }
+        with open(BASELINE_FILE, 'w') as f:
+            json.dump(baselines, f, indent=2)
+            f.write('\n')
+        print(f"\nSaved baseline for {machine} to {BASELINE_FILE}")
+    elif args.compare:
+        if machine not in baselines:
+            print(f"\nNo baseline for {machine}; run with --save-baseline first")
+            sys.exit(1)
+        regressions = compare(results, baselines[machine]['results'], args.tolerance)
+        if regressions:
+            print(f"\nRegressions against the {machine} baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"\nNo regressions against the {machine} baseline (tolerance {args.tolerance:.0%})")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
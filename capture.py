@@ -0,0 +1,101 @@
+"""
+Binary capture of raw BLE advertisements and a replay source for them
+"""
+import asyncio
+import logging
+import struct
+import time
+from typing import AsyncIterator, BinaryIO, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'VBLECAP1'
+# timestamp (epoch seconds), address length (0 = packed 6-byte MAC), payload length
+RECORD_HEADER = struct.Struct('<dBH')
+
+CapturedAdvertisement = Tuple[float, str, bytes]
+
+
+def pack_address(address: str) -> Tuple[int, bytes]:
+    """(length, bytes) for an address; length 0 means a MAC packed into 6 bytes"""
+    parts = address.split(':')
+    if len(parts) == 6 and all(len(part) == 2 for part in parts):
+        try:
+            return 0, bytes.fromhex(''.join(parts))
+        except ValueError:
+            pass
+    encoded = address.encode()
+    return len(encoded), encoded
+
+
+def unpack_address(length: int, data: bytes) -> str:
+    if length == 0:
+        return ':'.join(f"{byte:02X}" for byte in data)
+    return data.decode()
+
+
+class CaptureWriter:
+    """Appends (timestamp, address, raw bytes) records to a capture file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.count = 0
+        self._file: BinaryIO = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def write(self, timestamp: float, address: str, raw_data: bytes):
+        address_length, address_bytes = pack_address(address)
+        self._file.write(RECORD_HEADER.pack(timestamp, address_length, len(raw_data)))
+        self._file.write(address_bytes)
+        self._file.write(raw_data)
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+        logger.info(f"Captured {self.count} advertisements to {self.path}")
+
+
+def read_capture(path: str) -> Iterator[CapturedAdvertisement]:
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an advertisement capture file")
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            timestamp, address_length, data_length = RECORD_HEADER.unpack(header)
+            address = unpack_address(address_length, f.read(address_length or 6))
+            raw_data = f.read(data_length)
+            if len(raw_data) < data_length:
+                logger.warning(f"Truncated record at the end of {path}")
+                return
+            yield timestamp, address, raw_data
+
+
+async def replay_capture(path: str, speed: float = 1.0,
+                         loop_count: Optional[int] = 1) -> AsyncIterator[CapturedAdvertisement]:
+    """Yield captured advertisements with their original timestamps.
+
+    speed 1.0 reproduces the recorded pacing, 2.0 plays twice as fast and
+    0 plays as fast as the consumer accepts records.
+    """
+    iteration = 0
+    while loop_count is None or iteration < loop_count:
+        iteration += 1
+        first_recorded: Optional[float] = None
+        started = time.monotonic()
+        for count, (timestamp, address, raw_data) in enumerate(read_capture(path)):
+            if speed > 0:
+                if first_recorded is None:
+                    first_recorded = timestamp
+                delay = (timestamp - first_recorded) / speed - (time.monotonic() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif count % 100 == 0:
+                # Let the pipeline run between records at full speed
+                await asyncio.sleep(0)
+            yield timestamp, address, raw_data
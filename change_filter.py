@@ -0,0 +1,70 @@
+"""
+Change detection with per-metric deadbands and a max-silence heartbeat
+"""
+import time
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+
+class Deadband(NamedTuple):
+    absolute: float = 0.0
+    relative: float = 0.0  # Fraction of the last published value
+
+    def exceeded(self, last: float, value: float) -> bool:
+        delta = abs(value - last)
+        return delta > self.absolute and delta > self.relative * abs(last)
+
+
+def parse_deadbands(spec: Optional[str]) -> Dict[str, Deadband]:
+    """Parse "battery_voltage=0.05,solar_power=5%" into per-metric deadbands"""
+    deadbands: Dict[str, Deadband] = {}
+    if not spec:
+        return deadbands
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        metric, _, band = item.partition('=')
+        band = band.strip()
+        try:
+            if band.endswith('%'):
+                deadbands[metric.strip()] = Deadband(relative=float(band[:-1]) / 100)
+            else:
+                deadbands[metric.strip()] = Deadband(absolute=float(band))
+        except ValueError:
+            raise ValueError(f"Invalid deadband '{item}', expected metric=value or metric=value%")
+    return deadbands
+
+
+class ChangeFilter:
+    """Per-topic last-published cache deciding which values go on the wire"""
+
+    def __init__(self, deadbands: Optional[Dict[str, Deadband]] = None, heartbeat: float = 300.0):
+        self.deadbands = deadbands or {}
+        self.heartbeat = heartbeat
+        self._default = Deadband()
+        # topic -> (last published value, monotonic time it was published)
+        self._last: Dict[str, Tuple[Any, float]] = {}
+
+    def due(self, topic: str, now: Optional[float] = None) -> bool:
+        """True if the topic was never published or has been silent for a heartbeat"""
+        last = self._last.get(topic)
+        if last is None:
+            return True
+        return self.heartbeat > 0 and (now if now is not None else time.monotonic()) - last[1] >= self.heartbeat
+
+    def changed(self, topic: str, metric: str, value: Any, now: Optional[float] = None) -> bool:
+        if self.due(topic, now):
+            return True
+        last_value = self._last[topic][0]
+        if (isinstance(value, (int, float)) and isinstance(last_value, (int, float))
+                and not isinstance(value, bool) and not isinstance(last_value, bool)):
+            return self.deadbands.get(metric, self._default).exceeded(last_value, value)
+        return value != last_value
+
+    def mark_published(self, topic: str, value: Any, now: Optional[float] = None):
+        self._last[topic] = (value, now if now is not None else time.monotonic())
+
+    def forget(self, topic_prefix: str = ''):
+        """Drop cached values so the next reading is published in full"""
+        for topic in [t for t in self._last if t.startswith(topic_prefix)]:
+            del self._last[topic]
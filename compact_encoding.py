@@ -0,0 +1,222 @@
+"""
+Compact MessagePack encoding of complete readings with numeric field IDs and a versioned schema.
+
+A payload is the MessagePack array [schema version, epoch milliseconds,
+{field id: value}]; the schema that maps IDs back to names is published
+retained as JSON next to it. Only the MessagePack subset the readings need
+is implemented (nil, bool, int, float64, str, bin, array, map).
+"""
+import hashlib
+import json
+import struct
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+ENCODING = 'msgpack'
+
+
+def packb(value: Any) -> bytes:
+    out = bytearray()
+    _pack(value, out)
+    return bytes(out)
+
+
+def _pack(value: Any, out: bytearray):
+    if value is None:
+        out.append(0xc0)
+    elif value is True:
+        out.append(0xc3)
+    elif value is False:
+        out.append(0xc2)
+    elif isinstance(value, int):
+        _pack_int(value, out)
+    elif isinstance(value, float):
+        if value.is_integer() and abs(value) < 2 ** 53:
+            _pack_int(int(value), out)
+        else:
+            out.append(0xcb)
+            out += struct.pack('>d', value)
+    elif isinstance(value, str):
+        encoded = value.encode()
+        length = len(encoded)
+        if length < 32:
+            out.append(0xa0 | length)
+        elif length < 0x100:
+            out += struct.pack('>BB', 0xd9, length)
+        elif length < 0x10000:
+            out += struct.pack('>BH', 0xda, length)
+        else:
+            out += struct.pack('>BI', 0xdb, length)
+        out += encoded
+    elif isinstance(value, (bytes, bytearray)):
+        length = len(value)
+        if length < 0x100:
+            out += struct.pack('>BB', 0xc4, length)
+        elif length < 0x10000:
+            out += struct.pack('>BH', 0xc5, length)
+        else:
+            out += struct.pack('>BI', 0xc6, length)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        _pack_length(len(value), 0x90, 0xdc, out)
+        for item in value:
+            _pack(item, out)
+    elif isinstance(value, dict):
+        _pack_length(len(value), 0x80, 0xde, out)
+        for key, item in value.items():
+            _pack(key, out)
+            _pack(item, out)
+    else:
+        # Enums and other objects travel as their text form, like in the JSON payload
+        _pack(str(value), out)
+
+
+def _pack_int(value: int, out: bytearray):
+    if 0 <= value < 0x80:
+        out.append(value)
+    elif -32 <= value < 0:
+        out.append(value & 0xff)
+    elif 0 <= value < 0x100:
+        out += struct.pack('>BB', 0xcc, value)
+    elif 0 <= value < 0x10000:
+        out += struct.pack('>BH', 0xcd, value)
+    elif 0 <= value < 0x100000000:
+        out += struct.pack('>BI', 0xce, value)
+    elif 0 <= value:
+        out += struct.pack('>BQ', 0xcf, value)
+    elif -0x80 <= value:
+        out += struct.pack('>Bb', 0xd0, value)
+    elif -0x8000 <= value:
+        out += struct.pack('>Bh', 0xd1, value)
+    elif -0x80000000 <= value:
+        out += struct.pack('>Bi', 0xd2, value)
+    else:
+        out += struct.pack('>Bq', 0xd3, value)
+
+
+def _pack_length(length: int, fix: int, wide: int, out: bytearray):
+    # fix (up to 15 entries), 16-bit or 32-bit container length
+    if length < 16:
+        out.append(fix | length)
+    elif length < 0x10000:
+        out += struct.pack('>BH', wide, length)
+    else:
+        out += struct.pack('>BI', wide + 1, length)
+
+
+_FIXED = {
+    0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+    0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+    0xca: '>f', 0xcb: '>d',
+}
+
+
+def unpackb(data: bytes) -> Any:
+    value, _ = _unpack(data, 0)
+    return value
+
+
+def _unpack(data: bytes, pos: int) -> Tuple[Any, int]:
+    byte = data[pos]
+    pos += 1
+    if byte < 0x80:
+        return byte, pos
+    if byte >= 0xe0:
+        return byte - 0x100, pos
+    if 0xa0 <= byte <= 0xbf:
+        length = byte & 0x1f
+        return data[pos:pos + length].decode(), pos + length
+    if 0x90 <= byte <= 0x9f:
+        return _unpack_array(data, pos, byte & 0x0f)
+    if 0x80 <= byte <= 0x8f:
+        return _unpack_map(data, pos, byte & 0x0f)
+    if byte == 0xc0:
+        return None, pos
+    if byte in (0xc2, 0xc3):
+        return byte == 0xc3, pos
+    if byte in _FIXED:
+        fmt = _FIXED[byte]
+        return struct.unpack_from(fmt, data, pos)[0], pos + struct.calcsize(fmt)
+    if byte in (0xd9, 0xda, 0xdb, 0xc4, 0xc5, 0xc6):
+        fmt = {0xd9: '>B', 0xda: '>H', 0xdb: '>I', 0xc4: '>B', 0xc5: '>H', 0xc6: '>I'}[byte]
+        length = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+        raw = data[pos:pos + length]
+        return (raw.decode() if byte >= 0xd9 else bytes(raw)), pos + length
+    if byte in (0xdc, 0xdd, 0xde, 0xdf):
+        fmt = '>H' if byte in (0xdc, 0xde) else '>I'
+        length = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+        return (_unpack_array if byte in (0xdc, 0xdd) else _unpack_map)(data, pos, length)
+    raise ValueError(f"Unsupported MessagePack type byte {byte:#x}")
+
+
+def _unpack_array(data: bytes, pos: int, length: int) -> Tuple[List[Any], int]:
+    items = []
+    for _ in range(length):
+        item, pos = _unpack(data, pos)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(data: bytes, pos: int, length: int) -> Tuple[Dict[Any, Any], int]:
+    items = {}
+    for _ in range(length):
+        key, pos = _unpack(data, pos)
+        items[key], pos = _unpack(data, pos)
+    return items, pos
+
+
+class CompactSchema:
+    """Field name <-> numeric ID table for one topic, versioned by its field set"""
+
+    def __init__(self, fields: List[str]):
+        self.fields = sorted(fields)
+        self.ids = {name: index for index, name in enumerate(self.fields)}
+        digest = hashlib.sha1(json.dumps(self.fields).encode()).digest()
+        self.version = int.from_bytes(digest[:4], 'big')
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'version': self.version,
+            'encoding': ENCODING,
+            'layout': ['version', 'timestamp_ms', 'values'],
+            'fields': {str(index): name for index, name in enumerate(self.fields)},
+        })
+
+    def decode(self, payload: bytes) -> Dict[str, Any]:
+        """Reading dict back from a payload of this schema (for consumers and tests)"""
+        version, timestamp_ms, values = unpackb(payload)
+        if version != self.version:
+            raise ValueError(f"Payload schema {version} does not match {self.version}")
+        data = {self.fields[field_id]: value for field_id, value in values.items()}
+        data['timestamp_ms'] = timestamp_ms
+        return data
+
+
+class CompactEncoder:
+    """Encodes readings per topic; reports the schema whenever a topic's field set changes"""
+
+    def __init__(self):
+        self._schemas: Dict[str, CompactSchema] = {}
+
+    def encode(self, topic: str, data: Dict[str, Any]) -> Tuple[bytes, Optional[CompactSchema]]:
+        """(payload, schema to publish retained or None if unchanged since the last call)"""
+        names = [name for name, value in data.items() if name != 'timestamp' and value is not None]
+        schema = self._schemas.get(topic)
+        new_schema = None
+        if schema is None or any(name not in schema.ids for name in names):
+            known = set(schema.fields) if schema else set()
+            schema = new_schema = self._schemas[topic] = CompactSchema(sorted(known | set(names)))
+
+        # Reading records carry epoch milliseconds; plain dicts only the ISO text
+        timestamp_ms = getattr(data, 'timestamp_ms', None)
+        if timestamp_ms is None and data.get('timestamp'):
+            timestamp_ms = int(datetime.fromisoformat(data['timestamp']).timestamp() * 1000)
+        ids = schema.ids
+        payload = packb([schema.version, timestamp_ms, {ids[name]: data[name] for name in names}])
+        return payload, new_schema
+
+    def forget(self):
+        """Re-announce every schema on the next reading"""
+        self._schemas.clear()
@@ -0,0 +1,221 @@
+"""
+Derived metrics updated incrementally per reading: power, efficiency, energy and time per state today
+"""
+import json
+import logging
+import os
+import time
+from datetime import date, datetime
+from typing import Any, Dict, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_VERSION = 1
+
+# Power computed from voltage and current: derived field -> (voltage field, current field)
+POWER_PRODUCTS = {
+    'battery_charging_power': ('battery_voltage', 'battery_charging_current'),
+    'load_power': ('battery_voltage', 'external_device_load'),
+}
+# Power fields integrated into {name}_energy_today (Wh), raw or derived
+ENERGY_FIELDS = ('solar_power', 'battery_charging_power', 'load_power', 'ac_in_power', 'ac_out_power')
+# Fields whose time per value is accumulated into {field}_{value}_minutes_today
+STATE_FIELDS = ('charge_state', 'device_state')
+# Below this solar power the efficiency is mostly rounding noise of the reported values
+EFFICIENCY_MIN_POWER = 10.0
+
+
+def _day_start_ms(day: str) -> int:
+    """Local midnight starting day (YYYY-MM-DD) in epoch milliseconds"""
+    return int(datetime.combine(date.fromisoformat(day), datetime.min.time()).timestamp() * 1000)
+
+
+class _DeviceTotals:
+    """Running totals of one device for the current day"""
+
+    __slots__ = ('day', 'last_ms', 'powers', 'states', 'energy', 'seconds', 'peaks', 'samples')
+
+    def __init__(self, day: str):
+        self.day = day
+        self.last_ms: Optional[int] = None
+        self.powers: Dict[str, float] = {}  # Power fields of the previous reading
+        self.states: Dict[str, str] = {}  # State fields of the previous reading
+        self.energy: Dict[str, float] = {}  # Wh today per power field
+        self.seconds: Dict[str, Dict[str, float]] = {}  # State field -> value -> seconds today
+        self.peaks: Dict[str, float] = {}  # Highest power today per power field
+        self.samples = 0
+
+    def start_day(self, day: str):
+        # Keep the keys so the field set, and with it HA discovery, stays the same after midnight
+        self.day = day
+        self.energy = dict.fromkeys(self.energy, 0.0)
+        self.seconds = {field: dict.fromkeys(values, 0.0) for field, values in self.seconds.items()}
+        self.peaks = {}
+        self.samples = 0
+
+    def rollup(self) -> Dict[str, Any]:
+        return {
+            'date': self.day,
+            'samples': self.samples,
+            'energy_wh': {field[:-len('_power')]: round(wh, 1) for field, wh in self.energy.items()},
+            'minutes': {field: {value: round(seconds / 60, 1) for value, seconds in values.items()}
+                        for field, values in self.seconds.items()},
+            'peak_w': self.peaks,
+        }
+
+    def to_json(self) -> Dict[str, Any]:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    @classmethod
+    def from_json(cls, state: Dict[str, Any]) -> "_DeviceTotals":
+        totals = cls(state['day'])
+        for name in cls.__slots__:
+            setattr(totals, name, state[name])
+        return totals
+
+
+class DerivedMetrics:
+    """Per-device derived fields, updated from each reading without looking at history.
+
+    Energy is integrated with the trapezoidal rule between consecutive
+    readings and time is credited to the state of the earlier reading.
+    Intervals longer than max_gap seconds (device out of range, restart)
+    are not integrated. An interval spanning local midnight is split there;
+    the finished day is returned once as a rollup. Totals are checkpointed to
+    a JSON file every checkpoint_interval seconds and on close().
+    """
+
+    def __init__(self, checkpoint_path: Optional[str] = None, max_gap: float = 300.0,
+                 checkpoint_interval: float = 60.0):
+        self.checkpoint_path = checkpoint_path
+        self.max_gap_ms = max_gap * 1000
+        self.checkpoint_interval = checkpoint_interval
+        self._devices: Dict[str, _DeviceTotals] = {}
+        self._day = ''
+        self._day_start = self._day_end = 0
+        self._checkpointed = time.monotonic()
+        if checkpoint_path:
+            self._load()
+
+    def update(self, key: str, data: Mapping[str, Any], timestamp_ms: int
+               ) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        """(derived fields for this reading, rollup of a day that just ended or None)"""
+        day = self._local_day(timestamp_ms)
+        derived: Dict[str, Any] = {}
+        powers: Dict[str, float] = {}
+        for field, (voltage_field, current_field) in POWER_PRODUCTS.items():
+            voltage, current = data.get(voltage_field), data.get(current_field)
+            if field not in data and voltage is not None and current is not None:
+                derived[field] = round(voltage * current, 1)
+        for field in ENERGY_FIELDS:
+            value = derived.get(field, data.get(field))
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                powers[field] = float(value)
+        if 'solar_power' in powers and 'battery_charging_power' in powers:
+            output = powers['battery_charging_power'] + powers.get('load_power', 0.0)
+            solar = powers['solar_power']
+            derived['charger_efficiency'] = round(100 * output / solar, 1) if solar >= EFFICIENCY_MIN_POWER else None
+        states = {field: str(data[field]) for field in STATE_FIELDS if data.get(field) is not None}
+
+        totals = self._devices.get(key)
+        if totals is None:
+            totals = self._devices[key] = _DeviceTotals(day)
+        rollup = self._advance(totals, powers, states, timestamp_ms, day)
+
+        for field in powers:
+            totals.energy.setdefault(field, 0.0)
+            if powers[field] > totals.peaks.get(field, float('-inf')):
+                totals.peaks[field] = powers[field]
+        for field, value in states.items():
+            totals.seconds.setdefault(field, {}).setdefault(value, 0.0)
+        totals.samples += 1
+
+        for field in sorted(totals.energy):
+            derived[f"{field[:-len('_power')]}_energy_today"] = round(totals.energy[field])
+        for field in sorted(totals.seconds):
+            for value, seconds in sorted(totals.seconds[field].items()):
+                derived[f"{field}_{value.lower()}_minutes_today"] = round(seconds / 60)
+
+        if self.checkpoint_path and time.monotonic() - self._checkpointed >= self.checkpoint_interval:
+            self.checkpoint()
+        return derived, rollup
+
+    def _advance(self, totals: _DeviceTotals, powers: Dict[str, float], states: Dict[str, str],
+                 timestamp_ms: int, day: str) -> Optional[Dict[str, Any]]:
+        last_ms = totals.last_ms
+        integrate = last_ms is not None and 0 < timestamp_ms - last_ms <= self.max_gap_ms
+        rollup = None
+        if day != totals.day:
+            if integrate:
+                # Split the interval at midnight, interpolating the power there
+                boundary = self._day_start
+                fraction = min(max((boundary - last_ms) / (timestamp_ms - last_ms), 0.0), 1.0)
+                at_boundary = {field: previous + (powers[field] - previous) * fraction
+                               for field, previous in totals.powers.items() if field in powers}
+                self._integrate(totals, at_boundary, (boundary - last_ms) / 1000)
+                totals.powers = at_boundary
+                last_ms = boundary
+            rollup = totals.rollup()
+            totals.start_day(day)
+        if integrate:
+            self._integrate(totals, powers, (timestamp_ms - last_ms) / 1000)
+        totals.last_ms = timestamp_ms
+        totals.powers = powers
+        totals.states = states
+        return rollup
+
+    def _integrate(self, totals: _DeviceTotals, powers: Dict[str, float], seconds: float):
+        if seconds <= 0:
+            return
+        energy = totals.energy
+        for field, previous in totals.powers.items():
+            current = powers.get(field)
+            if current is not None:
+                energy[field] = energy.get(field, 0.0) + (previous + current) / 2 * seconds / 3600
+        for field, value in totals.states.items():
+            per_value = totals.seconds.setdefault(field, {})
+            per_value[value] = per_value.get(value, 0.0) + seconds
+
+    def _local_day(self, timestamp_ms: int) -> str:
+        # Formatting a date per reading is avoidable: it only changes at midnight
+        if not self._day_start <= timestamp_ms < self._day_end:
+            self._day = datetime.fromtimestamp(timestamp_ms / 1000).date().isoformat()
+            self._day_start = _day_start_ms(self._day)
+            self._day_end = _day_start_ms(date.fromordinal(date.fromisoformat(self._day).toordinal() + 1).isoformat())
+        return self._day
+
+    def checkpoint(self):
+        self._checkpointed = time.monotonic()
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'devices': {key: totals.to_json() for key, totals in self._devices.items()},
+        }
+        try:
+            with open(self.checkpoint_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+        except OSError as e:
+            logger.error(f"Error writing derived metrics checkpoint: {e}")
+
+    def _load(self):
+        try:
+            with open(self.checkpoint_path) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Ignoring unreadable derived metrics checkpoint: {e}")
+            return
+        if state.get('version') != CHECKPOINT_VERSION:
+            logger.warning(f"Ignoring derived metrics checkpoint version {state.get('version')}")
+            return
+        try:
+            self._devices = {key: _DeviceTotals.from_json(totals) for key, totals in state['devices'].items()}
+        except (KeyError, TypeError) as e:
+            logger.error(f"Ignoring malformed derived metrics checkpoint: {e}")
+            return
+        logger.info(f"Restored derived metrics for {len(self._devices)} device(s)")
+
+    def close(self):
+        if self.checkpoint_path:
+            self.checkpoint()
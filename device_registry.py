@@ -0,0 +1,129 @@
+"""
+Registry of Victron devices and their encryption keys, keyed by normalized address
+"""
+import json
+import logging
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from victron_ble.devices import Device, detect_device_type
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_TOPIC = "homeassistant/victron"
+
+
+def normalize_address(address: str) -> str:
+    """Canonical key for any address form: separators stripped, lowercase"""
+    return address.replace(':', '').replace('-', '').lower()
+
+
+def scanner_address(address: str) -> str:
+    """Address in the form the BLE stack reports it (aa:bb:cc:dd:ee:ff for MACs)"""
+    canonical = normalize_address(address)
+    if len(canonical) == 12:
+        return ':'.join(canonical[i:i+2] for i in range(0, 12, 2))
+    # Platform identifiers (e.g. CoreBluetooth UUIDs) are reported as configured
+    return address.lower()
+
+
+@dataclass
+class DeviceConfig:
+    address: str
+    key: str
+    name: str
+    topic_prefix: str
+    device: Optional[Device] = None  # Created from the first advertisement
+    schedule: Dict[str, Any] = field(default_factory=dict)  # Adaptive publish overrides
+
+    @property
+    def canonical(self) -> str:
+        return normalize_address(self.address)
+
+
+class DeviceRegistry:
+    def __init__(self, devices: List[DeviceConfig], dedup_window: int = 8):
+        self._devices: Dict[str, DeviceConfig] = {}
+        for config in devices:
+            if config.canonical in self._devices:
+                raise ValueError(f"Duplicate device address in registry: {config.address}")
+            self._devices[config.canonical] = config
+        # Last few frames per configured device; memory is bounded by the registry size
+        self.dedup_window = dedup_window
+        self._recent_frames: Dict[str, Deque[bytes]] = {
+            canonical: deque(maxlen=dedup_window) for canonical in self._devices
+        }
+
+    @classmethod
+    def from_file(cls, path: str, dedup_window: int = 8) -> "DeviceRegistry":
+        """Load devices from a JSON file: a list (or {"devices": [...]}) of
+        {"address", "key", optional "name", "topic" and "schedule"} objects"""
+        with open(path) as f:
+            entries = json.load(f)
+        if isinstance(entries, dict):
+            entries = entries.get('devices', [])
+
+        devices = []
+        for entry in entries:
+            if not entry.get('address') or not entry.get('key'):
+                raise ValueError(f"Device entry needs 'address' and 'key': {entry}")
+            name = entry.get('name') or normalize_address(entry['address'])
+            devices.append(DeviceConfig(
+                address=entry['address'],
+                key=entry['key'],
+                name=name,
+                topic_prefix=entry.get('topic', f"{DEFAULT_BASE_TOPIC}/{name}"),
+                schedule=entry.get('schedule') or {},
+            ))
+        logger.info(f"Loaded {len(devices)} devices from {path}")
+        return cls(devices, dedup_window)
+
+    @classmethod
+    def from_env(cls, address: str, key: str, dedup_window: int = 8) -> "DeviceRegistry":
+        """Single device from MPPT_MAC_ADDRESS/ENCRYPTION_KEY, published under the legacy topic tree"""
+        return cls([DeviceConfig(
+            address=address,
+            key=key,
+            name=normalize_address(address),
+            topic_prefix=DEFAULT_BASE_TOPIC,
+        )], dedup_window)
+
+    def lookup(self, address: str) -> Optional[DeviceConfig]:
+        return self._devices.get(normalize_address(address))
+
+    def get_device(self, address: str, raw_data: bytes) -> Optional[DeviceConfig]:
+        """Registry entry for a matching advertisement, with its parser instantiated"""
+        config = self._devices.get(normalize_address(address))
+        if config is None:
+            return None
+        if config.device is None:
+            device_klass = detect_device_type(raw_data)
+            if not device_klass:
+                logger.error(f"Could not identify device type for {address}")
+                return None
+            config.device = device_klass(config.key)
+        return config
+
+    def is_repeat(self, config: DeviceConfig, raw_data: bytes) -> bool:
+        """True if this device sent the identical frame recently.
+
+        Devices repeat an advertisement until their nonce advances, so a
+        repeated frame carries nothing new and need not be decrypted again.
+        """
+        if self.dedup_window <= 0:
+            return False
+        recent = self._recent_frames[config.canonical]
+        if raw_data in recent:
+            return True
+        recent.append(raw_data)
+        return False
+
+    def scanner_keys(self) -> Dict[str, str]:
+        return {scanner_address(config.address): config.key for config in self._devices.values()}
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def __iter__(self) -> Iterator[DeviceConfig]:
+        return iter(self._devices.values())
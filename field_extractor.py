@@ -0,0 +1,106 @@
+"""
+Compiled, per-class field extraction for victron_ble parsed data objects
+"""
+import enum
+import logging
+import typing
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from readings import MISSING, Reading, ReadingLayout
+
+logger = logging.getLogger(__name__)
+
+# How a getter's return value is turned into a JSON-friendly value
+PLAIN = 0  # Returned as-is
+ENUM = 1   # Annotated as an Enum: use .name
+PROBE = 2  # Unknown return type: fall back to probing for .name/.value
+
+
+def _conversion_for(func: Callable) -> int:
+    try:
+        return_type = typing.get_type_hints(func).get('return')
+    except Exception:
+        return PROBE
+    if return_type is None:
+        return PROBE
+    # Unwrap Optional[X] / X | None
+    candidates = [t for t in typing.get_args(return_type) if t is not type(None)] or [return_type]
+    if all(isinstance(t, type) and issubclass(t, enum.Enum) for t in candidates):
+        return ENUM
+    if all(isinstance(t, type) and t in (int, float, str, bool) for t in candidates):
+        return PLAIN
+    return PROBE
+
+
+class FieldExtractor:
+    """Getter list and enum-conversion plan for one parsed-data class, built once"""
+
+    def __init__(self, cls: type):
+        self.cls = cls
+        self.getters: List[Tuple[str, Callable, int]] = []
+        self.attributes: List[str] = []
+        for attr_name in dir(cls):
+            if attr_name.startswith('_'):
+                continue
+            attr_value = getattr(cls, attr_name)
+            if callable(attr_value):
+                if attr_name.startswith('get_'):
+                    # Remove 'get_' prefix for the field name
+                    self.getters.append((attr_name[4:], attr_value, _conversion_for(attr_value)))
+            else:
+                # Class constants and properties, read from each instance
+                self.attributes.append(attr_name)
+        self.layout = ReadingLayout(cls.__name__, tuple([name for name, _, _ in self.getters] + self.attributes))
+        logger.debug(f"Compiled extractor for {cls.__name__}: {[name for name, _, _ in self.getters]}")
+
+    def values(self, parsed_data: Any) -> List[Any]:
+        """Field values in layout order, MISSING where a getter failed"""
+        values: List[Any] = []
+        for field_name, getter, conversion in self.getters:
+            try:
+                value = getter(parsed_data)
+            except Exception as e:
+                logger.debug("Error calling get_%s: %s", field_name, e)
+                values.append(MISSING)
+                continue
+            # Convert enum values to strings for JSON serialization
+            if value is not None and conversion:
+                if conversion == ENUM:
+                    value = value.name
+                elif hasattr(value, 'name'):
+                    value = value.name
+                elif hasattr(value, 'value'):
+                    value = value.value
+            values.append(value)
+        for attr_name in self.attributes:
+            values.append(getattr(parsed_data, attr_name))
+        return values
+
+    def read(self, parsed_data: Any, timestamp_ms: int) -> Reading:
+        """Reading record for a parsed data object received at timestamp_ms (epoch milliseconds)"""
+        values = self.values(parsed_data)
+        layout = self.layout
+        # Public instance attributes are not visible on the class
+        instance_attrs = getattr(parsed_data, '__dict__', None)
+        if instance_attrs:
+            extra = [(name, value) for name, value in instance_attrs.items()
+                     if not name.startswith('_') and not callable(value) and name not in layout.index]
+            if extra:
+                layout = layout.extended(tuple(name for name, _ in extra))
+                values.extend(value for _, value in extra)
+        return Reading(layout, tuple(values), timestamp_ms)
+
+
+_extractors: Dict[type, FieldExtractor] = {}
+
+
+def get_extractor(cls: type) -> FieldExtractor:
+    extractor: Optional[FieldExtractor] = _extractors.get(cls)
+    if extractor is None:
+        extractor = _extractors[cls] = FieldExtractor(cls)
+    return extractor
+
+
+def extract_reading(parsed_data: Any, timestamp_ms: int) -> Reading:
+    """Reading record for a parsed data object, using the extractor cached for its class"""
+    return get_extractor(type(parsed_data)).read(parsed_data, timestamp_ms)
@@ -0,0 +1,130 @@
+"""
+Split deployment: scanner gateways forward raw advertisements over MQTT to a central decoder
+"""
+import asyncio
+import logging
+import struct
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Optional, Set, Tuple, Union
+
+from capture import pack_address, unpack_address
+from device_registry import normalize_address
+from mqtt_publisher import AsyncMQTTPublisher
+
+if TYPE_CHECKING:
+    from adapter_scanner import MultiAdapterScanner, RawScanner
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RAW_TOPIC = "victron/raw"
+# timestamp (epoch seconds), RSSI (dBm), gateway id length, address length (0 = packed 6-byte MAC)
+FRAME_HEADER = struct.Struct('<dbBB')
+
+
+class GatewayFrame(NamedTuple):
+    received_at: float
+    gateway: str
+    address: str
+    rssi: int
+    raw_data: bytes
+
+
+def encode_frame(frame: GatewayFrame) -> bytes:
+    gateway = frame.gateway.encode()
+    address_length, address = pack_address(frame.address)
+    rssi = max(-128, min(127, frame.rssi))
+    return FRAME_HEADER.pack(frame.received_at, rssi, len(gateway), address_length) + gateway + address + frame.raw_data
+
+
+def decode_frame(payload: bytes) -> GatewayFrame:
+    received_at, rssi, gateway_length, address_length = FRAME_HEADER.unpack_from(payload)
+    pos = FRAME_HEADER.size
+    gateway = payload[pos:pos + gateway_length].decode()
+    pos += gateway_length
+    address_size = address_length or 6
+    address = unpack_address(address_length, payload[pos:pos + address_size])
+    return GatewayFrame(received_at, gateway, address, rssi, payload[pos + address_size:])
+
+
+class ScannerGateway:
+    """Forwards raw advertisements to {topic}/{gateway_id}; decryption happens centrally"""
+
+    def __init__(self, publisher: AsyncMQTTPublisher, gateway_id: str, topic: str = DEFAULT_RAW_TOPIC,
+                 addresses: Optional[Set[str]] = None, adapters: Optional[List[str]] = None):
+        self.publisher = publisher
+        self.gateway_id = gateway_id
+        self.topic = f"{topic}/{gateway_id}"
+        # Canonical addresses to forward; None forwards every Victron device in range
+        self.addresses = addresses
+        self.adapters = adapters
+        self.forwarded = 0
+        self._scanner: Optional[Union[RawScanner, MultiAdapterScanner]] = None
+
+    def on_frame(self, address: str, rssi: int, raw_data: bytes, received_at: Optional[float] = None):
+        if self.addresses is not None and normalize_address(address) not in self.addresses:
+            return
+        frame = GatewayFrame(received_at or time.time(), self.gateway_id, address, rssi, raw_data)
+        self.publisher.publish(self.topic, encode_frame(frame), retain=False)
+        self.forwarded += 1
+
+    async def run(self):
+        # Imported here so the central decoder, which only needs the frame format, does not load bleak
+        from adapter_scanner import MultiAdapterScanner, RawScanner
+
+        if self.adapters:
+            self._scanner = MultiAdapterScanner(self.adapters, self.on_frame)
+        else:
+            self._scanner = RawScanner(self.on_frame)
+        await self._scanner.start()
+        logger.info(f"Gateway {self.gateway_id} forwarding advertisements to {self.topic}")
+        try:
+            while True:
+                await asyncio.sleep(60)
+                logger.info(f"Forwarded {self.forwarded} advertisements ({self.publisher.dropped} dropped)")
+        finally:
+            await self._scanner.stop()
+
+
+class _Candidate:
+    __slots__ = ('frame', 'copies')
+
+    def __init__(self, frame: GatewayFrame):
+        self.frame = frame
+        self.copies = 1
+
+
+class GatewayDeduplicator:
+    """Merges copies of one advertisement heard by several gateways.
+
+    The first copy opens a window of `window` seconds; copies arriving in it
+    are counted and the one with the best RSSI is emitted when it closes
+    (keeping the earliest reception time). window 0 emits the first copy at
+    once. Copies arriving after the window are left to the registry's
+    per-device repeat check.
+    """
+
+    def __init__(self, emit: Callable[[GatewayFrame, int], None], window: float = 0.25):
+        self.emit = emit
+        self.window = window
+        self.duplicates = 0
+        self._pending: Dict[Tuple[str, bytes], _Candidate] = {}
+
+    def add(self, frame: GatewayFrame):
+        if self.window <= 0:
+            self.emit(frame, 1)
+            return
+        key = (normalize_address(frame.address), frame.raw_data)
+        candidate = self._pending.get(key)
+        if candidate is None:
+            self._pending[key] = _Candidate(frame)
+            asyncio.get_running_loop().call_later(self.window, self._close, key)
+            return
+        self.duplicates += 1
+        candidate.copies += 1
+        if frame.rssi > candidate.frame.rssi:
+            candidate.frame = frame._replace(received_at=min(frame.received_at, candidate.frame.received_at))
+
+    def _close(self, key: Tuple[str, bytes]):
+        candidate = self._pending.pop(key, None)
+        if candidate is not None:
+            self.emit(candidate.frame, candidate.copies)
@@ -0,0 +1,123 @@
+"""
+Home Assistant MQTT discovery configs generated from the decoded field set
+"""
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+from device_registry import DeviceConfig
+
+logger = logging.getLogger(__name__)
+
+# Bump when the generated payload layout changes so every device is re-announced
+DISCOVERY_VERSION = 1
+
+# Fields that describe the device rather than being sensors of their own
+NON_SENSOR_FIELDS = {'timestamp', 'model_name'}
+
+# field -> (unit, device_class, state_class)
+FIELD_METADATA: Dict[str, Tuple[Optional[str], Optional[str], Optional[str]]] = {
+    'yield_today': ('Wh', 'energy', 'total_increasing'),
+    'yield_yesterday': ('Wh', 'energy', 'total'),
+    'yield_total': ('Wh', 'energy', 'total_increasing'),
+    'soc': ('%', 'battery', 'measurement'),
+    'remaining_mins': ('min', 'duration', 'measurement'),
+    'consumed_ah': ('Ah', None, 'measurement'),
+    'external_device_load': ('A', 'current', 'measurement'),
+    'ac_apparent_power': ('VA', 'apparent_power', 'measurement'),
+    'charger_efficiency': ('%', None, 'measurement'),
+}
+
+# Fallback by field-name suffix, checked in order
+SUFFIX_METADATA: List[Tuple[str, Tuple[Optional[str], Optional[str], Optional[str]]]] = [
+    ('_energy_today', ('Wh', 'energy', 'total_increasing')),
+    ('_minutes_today', ('min', 'duration', 'total_increasing')),
+    ('voltage', ('V', 'voltage', 'measurement')),
+    ('current', ('A', 'current', 'measurement')),
+    ('power', ('W', 'power', 'measurement')),
+    ('temperature', ('°C', 'temperature', 'measurement')),
+]
+
+
+def field_metadata(field: str, value: Any) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    if field in FIELD_METADATA:
+        return FIELD_METADATA[field]
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        # Enum states and other text values
+        return None, None, None
+    for suffix, metadata in SUFFIX_METADATA:
+        if field.endswith(suffix):
+            return metadata
+    return None, None, 'measurement'
+
+
+def schema_of(data: Dict[str, Any]) -> str:
+    """Schema version for a reading, derived from its field set"""
+    fields = sorted(key for key in data if key not in NON_SENSOR_FIELDS)
+    return hashlib.sha1(json.dumps([DISCOVERY_VERSION, fields]).encode()).hexdigest()[:12]
+
+
+class DiscoveryPublisher:
+    """Builds discovery configs once per device schema and tracks what has been announced"""
+
+    def __init__(self, prefix: str = "homeassistant"):
+        self.prefix = prefix
+        self.birth_topic = f"{prefix}/status"
+        # device canonical address -> (schema, [(topic, payload)])
+        self._configs: Dict[str, Tuple[str, List[Tuple[str, str]]]] = {}
+        # device canonical address -> schema that has been published
+        self._announced: Dict[str, str] = {}
+
+    def pending(self, device: DeviceConfig, data: Dict[str, Any]) -> List[Tuple[str, str]]:
+        """Discovery messages still to be published for this reading's schema (usually none)"""
+        schema = schema_of(data)
+        if self._announced.get(device.canonical) == schema:
+            return []
+        cached = self._configs.get(device.canonical)
+        if cached is None or cached[0] != schema:
+            cached = (schema, self._build(device, data))
+            self._configs[device.canonical] = cached
+            logger.info(f"Generated discovery for {device.name} (schema {schema}, {len(cached[1])} sensors)")
+        return cached[1]
+
+    def mark_announced(self, device: DeviceConfig):
+        if device.canonical in self._configs:
+            self._announced[device.canonical] = self._configs[device.canonical][0]
+
+    def on_birth(self, payload: bytes):
+        """Home Assistant (re)started: announce every device again on its next reading"""
+        if payload.strip() == b'online':
+            logger.info("Home Assistant came online, re-announcing discovery configs")
+            self._announced.clear()
+
+    def _build(self, device: DeviceConfig, data: Dict[str, Any]) -> List[Tuple[str, str]]:
+        node_id = f"victron_{device.canonical}"
+        device_info = {
+            'identifiers': [node_id],
+            'name': device.name,
+            'manufacturer': 'Victron Energy',
+        }
+        if data.get('model_name'):
+            device_info['model'] = str(data['model_name'])
+
+        messages = []
+        for field, value in data.items():
+            if field in NON_SENSOR_FIELDS:
+                continue
+            unit, device_class, state_class = field_metadata(field, value)
+            config: Dict[str, Any] = {
+                'name': field.replace('_', ' ').title(),
+                'unique_id': f"{node_id}_{field}",
+                'object_id': f"{node_id}_{field}",
+                'state_topic': f"{device.topic_prefix}/{field}",
+                'device': device_info,
+            }
+            if unit:
+                config['unit_of_measurement'] = unit
+            if device_class:
+                config['device_class'] = device_class
+            if state_class:
+                config['state_class'] = state_class
+            messages.append((f"{self.prefix}/sensor/{node_id}/{field}/config", json.dumps(config)))
+        return messages
@@ -0,0 +1,214 @@
+"""
+Latest reading per device, served as a JSON snapshot over HTTP and pushed to WebSocket clients
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import struct
+from typing import Dict, Optional, Set
+from urllib.parse import unquote
+
+from readings import Reading
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_TEXT, OP_CLOSE, OP_PING, OP_PONG = 0x1, 0x8, 0x9, 0xA
+# Clients only send control frames; anything bigger is not a client of ours
+MAX_CLIENT_FRAME = 4096
+
+
+def websocket_accept(key: str) -> str:
+    return base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest()).decode()
+
+
+def websocket_frame(payload: bytes, opcode: int = OP_TEXT) -> bytes:
+    """Unmasked, unfragmented server frame"""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class _Subscriber:
+    __slots__ = ('pending', 'wake')
+
+    def __init__(self):
+        # Newest frame per device not yet written; a slow client skips intermediate readings
+        self.pending: Dict[str, bytes] = {}
+        self.wake = asyncio.Event()
+
+
+class LatestValueCache:
+    """Newest reading per device. update() is a dict store unless WebSocket clients are connected;
+    then the message is serialized once and shared by every client."""
+
+    def __init__(self):
+        self._latest: Dict[str, Reading] = {}
+        self._subscribers: Set[_Subscriber] = set()
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+    @property
+    def clients(self) -> int:
+        return len(self._subscribers)
+
+    def update(self, device: str, reading: Reading):
+        self._latest[device] = reading
+        if self._subscribers:
+            frame = websocket_frame(self.message(device, reading).encode())
+            for subscriber in self._subscribers:
+                subscriber.pending[device] = frame
+                subscriber.wake.set()
+
+    def get(self, device: str) -> Optional[Reading]:
+        return self._latest.get(device)
+
+    @staticmethod
+    def message(device: str, reading: Reading) -> str:
+        return f'{{"device": {json.dumps(device)}, "data": {reading.to_json()}}}'
+
+    def snapshot(self) -> str:
+        """JSON object of device name -> latest reading"""
+        return '{' + ', '.join(f'{json.dumps(device)}: {reading.to_json()}'
+                               for device, reading in self._latest.items()) + '}'
+
+    def subscribe(self) -> _Subscriber:
+        subscriber = _Subscriber()
+        for device, reading in self._latest.items():
+            subscriber.pending[device] = websocket_frame(self.message(device, reading).encode())
+        subscriber.wake.set()
+        self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber):
+        self._subscribers.discard(subscriber)
+
+
+class LatestValueServer:
+    """GET /latest and /latest/{device} return JSON; GET /ws streams every new reading.
+
+    Runs on the caller's event loop as a plain asyncio socket server, like the
+    metrics endpoint.
+    """
+
+    def __init__(self, cache: LatestValueCache, host: str = '127.0.0.1', port: int = 8080,
+                 max_clients: int = 64):
+        self.cache = cache
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Serving latest values on http://{self.host}:{self.port}/latest and ws://{self.host}:{self.port}/ws")
+        return self.port
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            # WebSocket handlers only end when their client goes; close them from here
+            self._server.close_clients()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            lines = request.decode('latin-1').split('\r\n')
+            method, target = lines[0].split(' ')[:2]
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            path = unquote(target.split('?')[0])
+            if method != 'GET':
+                self._respond(writer, '405 Method Not Allowed')
+            elif path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                if self.cache.clients >= self.max_clients:
+                    self._respond(writer, '503 Service Unavailable')
+                else:
+                    await self._websocket(reader, writer, headers.get('sec-websocket-key', ''))
+            elif path == '/latest':
+                self._respond(writer, '200 OK', self.cache.snapshot().encode())
+            elif path.startswith('/latest/'):
+                reading = self.cache.get(path[len('/latest/'):])
+                if reading is None:
+                    self._respond(writer, '404 Not Found')
+                else:
+                    self._respond(writer, '200 OK', reading.to_json().encode())
+            else:
+                self._respond(writer, '404 Not Found')
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, writer: asyncio.StreamWriter, status: str, body: bytes = b''):
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Access-Control-Allow-Origin: *\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+
+    async def _websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, key: str):
+        if not key:
+            self._respond(writer, '400 Bad Request')
+            return
+        writer.write(
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {websocket_accept(key)}\r\n\r\n".encode()
+        )
+        subscriber = self.cache.subscribe()
+        receiver = asyncio.create_task(self._receive(reader, writer))
+        try:
+            while not receiver.done():
+                waiter = asyncio.ensure_future(subscriber.wake.wait())
+                await asyncio.wait((waiter, receiver), return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                subscriber.wake.clear()
+                pending, subscriber.pending = subscriber.pending, {}
+                if pending and not receiver.done():
+                    writer.write(b''.join(pending.values()))
+                    await writer.drain()
+        finally:
+            self.cache.unsubscribe(subscriber)
+            receiver.cancel()
+
+    async def _receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Answer pings and closes; returns when the client is gone"""
+        try:
+            while True:
+                first, second = await reader.readexactly(2)
+                opcode, length = first & 0x0F, second & 0x7F
+                if length == 126:
+                    length = struct.unpack('!H', await reader.readexactly(2))[0]
+                elif length == 127:
+                    length = struct.unpack('!Q', await reader.readexactly(8))[0]
+                if length > MAX_CLIENT_FRAME:
+                    writer.write(websocket_frame(struct.pack('!H', 1009), OP_CLOSE))
+                    return
+                mask = await reader.readexactly(4) if second & 0x80 else b'\x00' * 4
+                payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(await reader.readexactly(length)))
+                if opcode == OP_CLOSE:
+                    writer.write(websocket_frame(payload[:2], OP_CLOSE))
+                    return
+                if opcode == OP_PING:
+                    writer.write(websocket_frame(payload, OP_PONG))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return
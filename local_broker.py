@@ -0,0 +1,298 @@
+"""
+Minimal in-process MQTT broker stand-in for benchmarks and load tests.
+
+Speaks enough of MQTT 3.1.1 and 5 for paho clients: CONNECT,
+PUBLISH (QoS 0/1, retained, v5 topic aliases), SUBSCRIBE/UNSUBSCRIBE with
++/# wildcards, PING and DISCONNECT. Subscribers always receive QoS 0.
+No authentication, persistence or sessions.
+"""
+import asyncio
+import logging
+import struct
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+PROPERTY_TOPIC_ALIAS = 0x23
+PROPERTY_TOPIC_ALIAS_MAXIMUM = 0x22
+
+# Byte widths of fixed-size MQTT 5 properties, used to skip the ones we ignore
+_PROPERTY_WIDTHS = {
+    0x01: 1, 0x02: 4, 0x11: 4, 0x13: 2, 0x17: 1, 0x19: 1, 0x21: 2, 0x22: 2,
+    0x23: 2, 0x24: 1, 0x25: 1, 0x27: 4, 0x28: 1, 0x29: 1, 0x2A: 1,
+}
+_PROPERTY_STRINGS = {0x03, 0x08, 0x12, 0x15, 0x1A, 0x1C, 0x1F}
+_PROPERTY_BINARY = {0x09, 0x16}
+
+MessageHook = Callable[[str, bytes, bool], None]
+
+
+def encode_remaining_length(length: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        out.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(out)
+
+
+def decode_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def parse_properties(data: bytes, pos: int) -> Tuple[Dict[int, object], int]:
+    length, pos = decode_varint(data, pos)
+    end = pos + length
+    properties: Dict[int, object] = {}
+    while pos < end:
+        identifier = data[pos]
+        pos += 1
+        if identifier in _PROPERTY_WIDTHS:
+            width = _PROPERTY_WIDTHS[identifier]
+            properties[identifier] = int.from_bytes(data[pos:pos + width], 'big')
+            pos += width
+        elif identifier == 0x0B:
+            properties[identifier], pos = decode_varint(data, pos)
+        elif identifier in _PROPERTY_STRINGS or identifier in _PROPERTY_BINARY:
+            size = struct.unpack_from('>H', data, pos)[0]
+            properties[identifier] = data[pos + 2:pos + 2 + size]
+            pos += 2 + size
+        elif identifier == 0x26:
+            # User property: string pair
+            for _ in range(2):
+                size = struct.unpack_from('>H', data, pos)[0]
+                pos += 2 + size
+        else:
+            raise ValueError(f"Unknown MQTT property {identifier:#x}")
+    return properties, end
+
+
+def topic_matches(topic_filter: str, topic: str) -> bool:
+    filter_levels = topic_filter.split('/')
+    topic_levels = topic.split('/')
+    if topic.startswith('$') and not topic_filter.startswith('$'):
+        return False
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(topic_levels):
+            return False
+        if level != '+' and level != topic_levels[index]:
+            return False
+    return len(filter_levels) == len(topic_levels)
+
+
+class _Session:
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.protocol = 4
+        self.client_id = ''
+        self.subscriptions: Set[str] = set()
+        self.aliases: Dict[int, str] = {}
+
+    def send(self, packet_type: int, flags: int, body: bytes):
+        self.writer.write(bytes([packet_type << 4 | flags]) + encode_remaining_length(len(body)) + body)
+
+
+class LocalBroker:
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, topic_alias_maximum: int = 1000):
+        self.host = host
+        self.port = port
+        self.topic_alias_maximum = topic_alias_maximum
+        self.retained: Dict[str, bytes] = {}
+        self.messages_received = 0
+        self.bytes_received = 0
+        self.packets_received = 0
+        self._sessions: List[_Session] = []
+        self._hooks: List[MessageHook] = []
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    def add_hook(self, hook: MessageHook):
+        """Call hook(topic, payload, retain) in-process for every PUBLISH received"""
+        self._hooks.append(hook)
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Local MQTT broker listening on {self.host}:{self.port}")
+        return self.port
+
+    async def stop(self):
+        for session in list(self._sessions):
+            session.writer.close()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def __aenter__(self) -> "LocalBroker":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.stop()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        session = _Session(writer)
+        self._sessions.append(session)
+        try:
+            while True:
+                header = await reader.readexactly(1)
+                length = shift = 0
+                while True:
+                    byte = (await reader.readexactly(1))[0]
+                    length |= (byte & 0x7f) << shift
+                    shift += 7
+                    if not byte & 0x80:
+                        break
+                body = await reader.readexactly(length) if length else b''
+                self.packets_received += 1
+                self.bytes_received += 1 + length
+                if not self._dispatch(session, header[0] >> 4, header[0] & 0x0f, body):
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Local broker dropped client {session.client_id}: {e}")
+        finally:
+            self._sessions.remove(session)
+            writer.close()
+
+    def _dispatch(self, session: _Session, packet_type: int, flags: int, body: bytes) -> bool:
+        if packet_type == CONNECT:
+            self._on_connect(session, body)
+        elif packet_type == PUBLISH:
+            self._on_publish(session, flags, body)
+        elif packet_type == SUBSCRIBE:
+            self._on_subscribe(session, body)
+        elif packet_type == UNSUBSCRIBE:
+            self._on_unsubscribe(session, body)
+        elif packet_type == PINGREQ:
+            session.send(PINGRESP, 0, b'')
+        elif packet_type == DISCONNECT:
+            return False
+        return True
+
+    def _on_connect(self, session: _Session, body: bytes):
+        name_length = struct.unpack_from('>H', body, 0)[0]
+        pos = 2 + name_length
+        session.protocol = body[pos]
+        pos += 4  # level, flags, keepalive
+        if session.protocol == 5:
+            _, pos = parse_properties(body, pos)
+        id_length = struct.unpack_from('>H', body, pos)[0]
+        session.client_id = body[pos + 2:pos + 2 + id_length].decode(errors='replace')
+        if session.protocol == 5:
+            properties = bytes([PROPERTY_TOPIC_ALIAS_MAXIMUM]) + struct.pack('>H', self.topic_alias_maximum)
+            session.send(CONNACK, 0, b'\x00\x00' + encode_remaining_length(len(properties)) + properties)
+        else:
+            session.send(CONNACK, 0, b'\x00\x00')
+
+    def _on_publish(self, session: _Session, flags: int, body: bytes):
+        qos = (flags >> 1) & 0x03
+        retain = bool(flags & 0x01)
+        topic_length = struct.unpack_from('>H', body, 0)[0]
+        topic = body[2:2 + topic_length].decode()
+        pos = 2 + topic_length
+        packet_id = None
+        if qos:
+            packet_id = struct.unpack_from('>H', body, pos)[0]
+            pos += 2
+        if session.protocol == 5:
+            properties, pos = parse_properties(body, pos)
+            alias = properties.get(PROPERTY_TOPIC_ALIAS)
+            if alias:
+                if topic:
+                    session.aliases[alias] = topic
+                else:
+                    topic = session.aliases[alias]
+        payload = body[pos:]
+        if packet_id is not None:
+            session.send(PUBACK, 0, struct.pack('>H', packet_id))
+
+        self.messages_received += 1
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for hook in self._hooks:
+            hook(topic, payload, retain)
+        for subscriber in self._sessions:
+            if any(topic_matches(topic_filter, topic) for topic_filter in subscriber.subscriptions):
+                self._deliver(subscriber, topic, payload, False)
+
+    def _deliver(self, session: _Session, topic: str, payload: bytes, retain: bool):
+        encoded_topic = topic.encode()
+        body = struct.pack('>H', len(encoded_topic)) + encoded_topic
+        if session.protocol == 5:
+            body += b'\x00'
+        session.send(PUBLISH, int(retain), body + payload)
+
+    def _on_subscribe(self, session: _Session, body: bytes):
+        packet_id = struct.unpack_from('>H', body, 0)[0]
+        pos = 2
+        if session.protocol == 5:
+            _, pos = parse_properties(body, pos)
+        granted = bytearray()
+        new_filters = []
+        while pos < len(body):
+            length = struct.unpack_from('>H', body, pos)[0]
+            topic_filter = body[pos + 2:pos + 2 + length].decode()
+            pos += 3 + length  # filter plus options byte
+            session.subscriptions.add(topic_filter)
+            new_filters.append(topic_filter)
+            granted.append(0)
+        reply = struct.pack('>H', packet_id) + (b'\x00' if session.protocol == 5 else b'') + bytes(granted)
+        session.send(SUBACK, 0, reply)
+        for topic, payload in self.retained.items():
+            if any(topic_matches(topic_filter, topic) for topic_filter in new_filters):
+                self._deliver(session, topic, payload, True)
+
+    def _on_unsubscribe(self, session: _Session, body: bytes):
+        packet_id = struct.unpack_from('>H', body, 0)[0]
+        pos = 2
+        if session.protocol == 5:
+            _, pos = parse_properties(body, pos)
+        count = 0
+        while pos < len(body):
+            length = struct.unpack_from('>H', body, pos)[0]
+            session.subscriptions.discard(body[pos + 2:pos + 2 + length].decode())
+            pos += 2 + length
+            count += 1
+        reply = struct.pack('>H', packet_id)
+        if session.protocol == 5:
+            reply += b'\x00' + b'\x00' * count
+        session.send(UNSUBACK, 0, reply)
+
+
+async def serve_forever(host: str = '127.0.0.1', port: int = 1883):
+    broker = LocalBroker(host, port)
+    await broker.start()
+    started = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(10)
+            rate = broker.messages_received / (time.monotonic() - started)
+            logger.info(f"{broker.messages_received} messages received ({rate:.1f} msg/s)")
+    finally:
+        await broker.stop()
+
+
+if __name__ == "__main__":
+    import os
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(serve_forever(os.getenv('BROKER_HOST', '127.0.0.1'), int(os.getenv('BROKER_PORT', '1883'))))
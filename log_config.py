@@ -0,0 +1,63 @@
+"""
+Logging setup: configurable level, optional JSON lines, and per-key rate limiting for chatty messages
+"""
+import json
+import logging
+from typing import Dict, List, Optional
+
+# Attributes every LogRecord has; anything else was passed through extra= and is kept as a field
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with extra= fields as top-level keys"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging(level: str = 'INFO', fmt: str = 'text'):
+    """Replace the root handlers with one stderr handler; fmt is 'text' or 'json'"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(logging.BASIC_FORMAT))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper())
+
+
+class RateLimiter:
+    """Lets one event per key through every interval seconds and counts the ones it held back.
+
+    At most max_keys keys are tracked; the least recently allowed key is
+    forgotten first, so a crowded BLE neighbourhood cannot grow it without bound.
+    """
+
+    def __init__(self, interval: float, max_keys: int = 1024):
+        self.interval = interval
+        self.max_keys = max_keys
+        # key -> [last allowed at, suppressed since]
+        self._state: Dict[str, List[float]] = {}
+
+    def allow(self, key: str, now: float) -> Optional[int]:
+        """Number of events suppressed since the last allowed one, or None to suppress this one"""
+        state = self._state.get(key)
+        if state is not None:
+            if now - state[0] < self.interval:
+                state[1] += 1
+                return None
+            del self._state[key]
+        elif len(self._state) >= self.max_keys:
+            del self._state[next(iter(self._state))]
+        self._state[key] = [now, 0]
+        return int(state[1]) if state else 0
@@ -3,18 +3,52 @@ import asyncio
 import os
 import json
 import logging
-from datetime import datetime
-from typing import Dict, Any, Optional
+import signal
+import socket
+import struct
+import time
+from typing import TYPE_CHECKING, Dict, Any, NamedTuple, Optional, Set, Union
 
 from dotenv import load_dotenv
-from victron_ble.devices import Device
-from victron_ble.scanner import Scanner
-import paho.mqtt.client as mqtt
+
+from change_filter import ChangeFilter, parse_deadbands
+from device_registry import DeviceConfig, DeviceRegistry, normalize_address
+from field_extractor import extract_reading
+from gateway import DEFAULT_RAW_TOPIC, GatewayDeduplicator, GatewayFrame, ScannerGateway, decode_frame
+from ha_discovery import DiscoveryPublisher
+from log_config import RateLimiter, configure_logging
+import metrics
+from mqtt_publisher import PROTOCOLS, AsyncMQTTPublisher
+from offline_queue import OfflineQueue
+from readings import Reading
+
+# Optional features and the BLE stack are imported where they are enabled, so a restart
+# only pays for what it uses and the broker connection is under way while bleak loads
+if TYPE_CHECKING:
+    from victron_ble.scanner import Scanner
+    from adapter_scanner import MultiAdapterScanner
+    from aggregation import TumblingAggregator
+    from capture import CaptureWriter
+    from compact_encoding import CompactEncoder
+    from derived_metrics import DerivedMetrics
+    from latest_cache import LatestValueCache, LatestValueServer
+    from publish_scheduler import AdaptiveScheduler
+    from scanner_watchdog import ScannerWatchdog
+    from timeseries_store import TimeSeriesStore
 
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
+IMPORTED_AT = time.time()
+
+# Seconds to wait for BlueZ to start or stop a scan before giving up on it
+SCANNER_START_TIMEOUT = 10
+
+
+class Advertisement(NamedTuple):
+    received_at: float  # epoch seconds at reception
+    address: str
+    raw_data: bytes
 
 
 class VictronMPPTReader:
@@ -23,202 +57,712 @@ class VictronMPPTReader:
         # Format: "763aeff5-1334-e64a-ab30-a0f478s20fe1" (not a standard BLE MAC address)
         self.mac_address = os.getenv('MPPT_MAC_ADDRESS')
         self.encryption_key = os.getenv('ENCRYPTION_KEY')
+        # DEVICES_CONFIG points at a JSON device list for fleets; it replaces the single-device variables
+        self.devices_config = os.getenv('DEVICES_CONFIG')
         self.mqtt_host = os.getenv("MQTT_HOST")
         self.mqtt_user = os.getenv('MQTT_USER')
         self.mqtt_password = os.getenv('MQTT_PASSWORD')
-        self.device: Optional[Device] = None
-        self.mqtt_client: Optional[mqtt.Client] = None
+        # POLL_INTERVAL=0 publishes every new advertisement as it arrives;
+        # a positive value publishes the latest advertisement every N seconds
+        self.poll_interval = float(os.getenv('POLL_INTERVAL', '0'))
+        self.scan_timeout = float(os.getenv('SCAN_TIMEOUT', '5'))
+        # Only changed values are published; DEADBANDS is e.g. "battery_voltage=0.05,solar_power=5%"
+        self.deadbands = parse_deadbands(os.getenv('DEADBANDS'))
+        # DEADBANDS names no decoded field has matched yet; checked until every device has reported once
+        self.unmatched_deadbands: Set[str] = set(self.deadbands)
+        self.devices_reported: Set[str] = set()
+        self.decoded_fields: Set[str] = set()
+        self.change_filter: Optional[ChangeFilter] = None
+        if os.getenv('CHANGE_DETECTION', '1') != '0':
+            self.change_filter = ChangeFilter(
+                self.deadbands,
+                heartbeat=float(os.getenv('PUBLISH_HEARTBEAT', '300')),
+            )
+        self.mqtt_port = int(os.getenv('MQTT_PORT', '1883'))
+        self.mqtt_qos = int(os.getenv('MQTT_QOS', '1'))
+        self.mqtt_max_inflight = int(os.getenv('MQTT_MAX_INFLIGHT', '20'))
+        self.mqtt_queue_size = int(os.getenv('MQTT_QUEUE_SIZE', '1000'))
+        # MQTT_PROTOCOL=5 sends repeated topics as MQTT 5 topic aliases (at most MQTT_TOPIC_ALIASES,
+        # further capped by the broker); 3.1.1 stays the default for older brokers
+        mqtt_protocol = os.getenv('MQTT_PROTOCOL', '3.1.1')
+        if mqtt_protocol not in PROTOCOLS:
+            raise ValueError(f"Unsupported MQTT_PROTOCOL: {mqtt_protocol}")
+        self.mqtt_protocol = PROTOCOLS[mqtt_protocol]
+        self.mqtt_topic_aliases = int(os.getenv('MQTT_TOPIC_ALIASES', '1000'))
+        # A lost broker session is re-established in-process with jittered exponential backoff;
+        # MQTT_ACK_TIMEOUT also drops a session whose publishes stop being acknowledged
+        self.mqtt_keepalive = int(os.getenv('MQTT_KEEPALIVE', '60'))
+        self.mqtt_ack_timeout = float(os.getenv('MQTT_ACK_TIMEOUT', '30'))
+        self.mqtt_reconnect_max = float(os.getenv('MQTT_RECONNECT_MAX_DELAY', '60'))
+        self.publisher: Optional[AsyncMQTTPublisher] = None
+        # Until the first broker connection, but at most MQTT_STARTUP_GRACE seconds after start,
+        # readings wait in the publish queue rather than the offline queue, so they go out live
+        self.mqtt_startup_grace = float(os.getenv('MQTT_STARTUP_GRACE', '10'))
+        self.first_published = asyncio.Event()
+        # Readings taken while the broker is unreachable are buffered on disk and replayed
+        # afterwards on {topic}/history with their original timestamps
+        self.offline_queue_dir = os.getenv('OFFLINE_QUEUE_DIR', 'offline_queue')
+        self.offline_queue_max_mb = int(os.getenv('OFFLINE_QUEUE_MAX_MB', '64'))
+        self.offline_replay_batch = int(os.getenv('OFFLINE_REPLAY_BATCH', '50'))
+        self.offline_replay_rate = float(os.getenv('OFFLINE_REPLAY_RATE', '20'))
+        self.offline_queue: Optional[OfflineQueue] = None
+        # AGGREGATION_WINDOW > 0 publishes once per window: the window's last values plus
+        # min/max/mean/last/count per numeric field on {topic}/aggregate
+        self.aggregation_window = float(os.getenv('AGGREGATION_WINDOW', '0'))
+        self.aggregator: Optional[TumblingAggregator] = None
+        if self.aggregation_window > 0:
+            from aggregation import TumblingAggregator
+            self.aggregator = TumblingAggregator(self.aggregation_window)
+        # ALL_ENCODING=msgpack publishes {topic}/all as compact MessagePack with numeric field IDs;
+        # the ID table is published retained as JSON on {topic}/schema whenever it changes
+        self.all_encoding = os.getenv('ALL_ENCODING', 'json').lower()
+        if self.all_encoding not in ('json', 'msgpack'):
+            raise ValueError(f"Unsupported ALL_ENCODING: {self.all_encoding}")
+        self.compact_encoder: Optional[CompactEncoder] = None
+        if self.all_encoding == 'msgpack':
+            from compact_encoding import CompactEncoder
+            self.compact_encoder = CompactEncoder()
+        # DERIVED_METRICS=1 adds charging/load power, charger efficiency, energy today and minutes per
+        # charge state to each reading and publishes each finished day on {topic}/daily; the running
+        # totals survive restarts through DERIVED_CHECKPOINT
+        self.derived: Optional[DerivedMetrics] = None
+        if os.getenv('DERIVED_METRICS', '0') != '0':
+            from derived_metrics import DerivedMetrics
+            self.derived = DerivedMetrics(
+                os.getenv('DERIVED_CHECKPOINT', 'derived_metrics.json'),
+                max_gap=float(os.getenv('DERIVED_MAX_GAP', '300')),
+            )
+        # CAPTURE_FILE records every advertisement seen; REPLAY_FILE feeds a capture through
+        # the pipeline instead of scanning (REPLAY_SPEED 1 = recorded pacing, 0 = max speed)
+        self.capture: Optional[CaptureWriter] = None
+        if os.getenv('CAPTURE_FILE'):
+            from capture import CaptureWriter
+            self.capture = CaptureWriter(os.getenv('CAPTURE_FILE'))
+        self.replay_file = os.getenv('REPLAY_FILE')
+        self.replay_speed = float(os.getenv('REPLAY_SPEED', '1'))
+        self.replay_clock: Optional[float] = None  # Capture time of the last replayed advertisement
+        # TIMESERIES_DIR keeps every decoded reading in a local compressed time-series store
+        self.timeseries: Optional[TimeSeriesStore] = None
+        if os.getenv('TIMESERIES_DIR'):
+            from timeseries_store import TimeSeriesStore
+            self.timeseries = TimeSeriesStore(
+                os.getenv('TIMESERIES_DIR'),
+                block_rows=int(os.getenv('TIMESERIES_BLOCK_ROWS', '3600')),
+                flush_interval=float(os.getenv('TIMESERIES_FLUSH_INTERVAL', '600')),
+            )
+        # Home Assistant discovery is announced once per device schema and again after HA's birth message
+        self.discovery: Optional[DiscoveryPublisher] = None
+        if os.getenv('HA_DISCOVERY', '1') != '0':
+            self.discovery = DiscoveryPublisher(os.getenv('HA_DISCOVERY_PREFIX', 'homeassistant'))
+        self.scanner: Optional[Union[Scanner, MultiAdapterScanner]] = None
+        # ADAPTERS=hci0,hci1 scans on several adapters; a device whose adapter has not heard
+        # it for ADAPTER_FAILOVER seconds moves to another adapter
+        self.adapters = [a.strip() for a in os.getenv('ADAPTERS', '').split(',') if a.strip()]
+        self.adapter_failover = float(os.getenv('ADAPTER_FAILOVER', '30'))
+        self.latest_advertisements: Dict[str, Advertisement] = {}
+        self.advertisements: asyncio.Queue = asyncio.Queue(maxsize=int(os.getenv('ADVERTISEMENT_QUEUE_SIZE', '256')))
+        self.device_found = asyncio.Event()
+        # "Discovered device" is logged once per address every LOG_DISCOVERY_INTERVAL seconds
+        self.discovery_log = RateLimiter(float(os.getenv('LOG_DISCOVERY_INTERVAL', '300')))
+        metrics.ADVERTISEMENT_QUEUE_DEPTH.set_function(self.advertisements.qsize)
+        # METRICS_PORT serves Prometheus-style metrics on http://METRICS_HOST:METRICS_PORT/metrics
+        self.metrics_host = os.getenv('METRICS_HOST', '127.0.0.1')
+        self.metrics_port = int(os.getenv('METRICS_PORT', '0'))
+        self.metrics_server: Optional[metrics.MetricsServer] = None
+        # LIVE_PORT serves each device's latest reading on http://LIVE_HOST:LIVE_PORT/latest
+        # and pushes every new one to WebSocket clients on /ws, without going through the broker
+        self.live_host = os.getenv('LIVE_HOST', '127.0.0.1')
+        self.live_port = int(os.getenv('LIVE_PORT', '0'))
+        self.live_max_clients = int(os.getenv('LIVE_MAX_CLIENTS', '64'))
+        self.latest: Optional[LatestValueCache] = None
+        self.live_server: Optional[LatestValueServer] = None
+        if self.live_port:
+            from latest_cache import LatestValueCache
+            self.latest = LatestValueCache()
+            metrics.LIVE_CLIENTS.set_function(lambda: self.latest.clients)
+        # GATEWAY_MODE=central decodes raw advertisements forwarded by scanner gateways
+        # (GATEWAY_MODE=gateway nodes) instead of scanning locally
+        self.central = os.getenv('GATEWAY_MODE', '').lower() == 'central'
+        self.gateway_topic = os.getenv('GATEWAY_TOPIC', DEFAULT_RAW_TOPIC)
+        self.gateway_dedup = GatewayDeduplicator(self.on_gateway_frame, float(os.getenv('GATEWAY_DEDUP_WINDOW', '0.25')))
         
-        if not all([self.mac_address, self.encryption_key, self.mqtt_user, self.mqtt_password]):
+        if not all([self.mqtt_user, self.mqtt_password]):
+            raise ValueError("Missing required environment variables")
+        # DEDUP_WINDOW is how many recent frames per device are remembered to skip repeats (0 disables)
+        dedup_window = int(os.getenv('DEDUP_WINDOW', '8'))
+        if self.devices_config:
+            self.registry = DeviceRegistry.from_file(self.devices_config, dedup_window)
+        elif self.mac_address and self.encryption_key:
+            self.registry = DeviceRegistry.from_env(self.mac_address, self.encryption_key, dedup_window)
+        else:
             raise ValueError("Missing required environment variables")
+        
+        # ADAPTIVE_PUBLISH=1 publishes state changes and big swings at once and backs off
+        # towards SCHEDULE_MAX_INTERVAL while values are flat; devices can override per entry
+        self.scheduler: Optional[AdaptiveScheduler] = None
+        if os.getenv('ADAPTIVE_PUBLISH', '0') != '0':
+            from publish_scheduler import AdaptiveScheduler, SchedulePolicy
+            default_policy = SchedulePolicy(
+                min_interval=float(os.getenv('SCHEDULE_MIN_INTERVAL', '2')),
+                max_interval=float(os.getenv('SCHEDULE_MAX_INTERVAL', '300')),
+                jump=float(os.getenv('SCHEDULE_JUMP', '0.2')),
+                noise=float(os.getenv('SCHEDULE_NOISE', '0.01')),
+            )
+            self.scheduler = AdaptiveScheduler(default_policy, self.deadbands)
+            for config in self.registry:
+                if config.schedule:
+                    self.scheduler.set_policy(config.canonical, default_policy.updated(config.schedule))
+        
+        # The scanner watchdog restarts only the scanner once no device has been heard for
+        # SCANNER_STALL_FACTOR times its usual advertisement interval (at least SCANNER_STALL_MIN
+        # seconds), retrying with jittered backoff up to SCANNER_RESTART_MAX_DELAY; SCANNER_WATCHDOG=0 disables it
+        self.watchdog: Optional[ScannerWatchdog] = None
+        if os.getenv('SCANNER_WATCHDOG', '1') != '0' and not (self.replay_file or self.central):
+            from scanner_watchdog import ScannerWatchdog
+            self.watchdog = ScannerWatchdog(
+                [config.canonical for config in self.registry],
+                self.restart_scanner,
+                factor=float(os.getenv('SCANNER_STALL_FACTOR', '5')),
+                min_silence=float(os.getenv('SCANNER_STALL_MIN', '3')),
+                max_delay=float(os.getenv('SCANNER_RESTART_MAX_DELAY', '60')),
+            )
+            metrics.SECONDS_SINCE_ADVERTISEMENT.set_function(self.watchdog.silence)
     
     async def connect_to_mppt(self) -> bool:
+        """Start the long-running scanner and wait for the first matching advertisement"""
+        logger.info(f"Scanning for {len(self.registry)} device(s)")
+        for config in self.registry:
+            logger.info(f"Using device key: {config.name} ({config.address}) -> {config.key[:8]}...")
+        if not await self.start_scanner():
+            return False
+        
         try:
-            logger.info(f"Connecting to MPPT at {self.mac_address}")
-            
-            # Create scanner with device keys - format as proper BLE MAC address
-            # Convert device identifier to BLE MAC format (DA:6F:E9:6F:94:CE)
-            formatted_mac = ':'.join(self.mac_address[i:i+2] for i in range(0, len(self.mac_address), 2)).upper()
-            device_keys = {formatted_mac: self.encryption_key}
-            logger.info(f"Using device key: {formatted_mac} -> {self.encryption_key[:8]}...")
-            scanner = Scanner(device_keys)
-            
-            # Set up a flag to track if device is found
-            self.device_found = False
-            
-            # Override the callback to capture our device
-            def custom_callback(ble_device, raw_data):
-                logger.info(f"Discovered device: {ble_device.address}")
-                # Try to get device using the scanner (it will match against our device_keys)
-                try:
-                    device = scanner.get_device(ble_device, raw_data)
-                    if device:
-                        logger.info(f"Found matching device: {ble_device.address}")
-                        self.device = device
-                        self.raw_data = raw_data  # Store raw data for parsing
-                        self.device_found = True
-                except Exception as e:
-                    logger.debug(f"Device {ble_device.address} not matching: {e}")
-            
-            scanner.callback = custom_callback
-            
-            # Start scanning
-            await scanner.start()
-            
-            # Wait a bit for device discovery
-            import asyncio
-            await asyncio.sleep(5)
-            
-            # Stop scanning
-            await scanner.stop()
-            
-            if self.device and self.device_found:
-                logger.info("Successfully connected to MPPT")
-                return True
+            await asyncio.wait_for(self.device_found.wait(), timeout=self.scan_timeout)
+        except asyncio.TimeoutError:
+            pass
+        
+        if self.device_found.is_set():
+            logger.info("Successfully connected to MPPT")
+            return True
+        else:
+            logger.error("Failed to find or connect to MPPT device")
+            await self.stop_scanner()
+            return False
+    
+    async def start_scanner(self) -> bool:
+        """Create and start a scanner; it keeps running until stop_scanner()"""
+        try:
+            if self.adapters:
+                from adapter_scanner import MultiAdapterScanner
+                # Several adapters: each device is read through the adapter that hears it best
+                scanner = MultiAdapterScanner(
+                    self.adapters,
+                    lambda address, rssi, raw_data: self.handle_advertisement(address, raw_data),
+                    failover_after=self.adapter_failover,
+                )
             else:
-                logger.error("Failed to find or connect to MPPT device")
-                return False
+                from victron_ble.scanner import Scanner
+                # One scanner serves every device in the registry
+                scanner = Scanner(self.registry.scanner_keys())
                 
+                # Override the callback to stream every matching advertisement into the pipeline
+                def custom_callback(ble_device, raw_data):
+                    self.handle_advertisement(ble_device.address, raw_data)
+                
+                scanner.callback = custom_callback
+            self.scanner = scanner
+            await asyncio.wait_for(scanner.start(), SCANNER_START_TIMEOUT)
+            return True
         except Exception as e:
             logger.error(f"Error connecting to MPPT: {e}")
+            await self.stop_scanner()
             return False
     
+    async def restart_scanner(self) -> bool:
+        """Replace the scanner with a fresh one, leaving the pipeline and the broker session alone"""
+        await self.stop_scanner()
+        return await self.start_scanner()
+    
+    def handle_advertisement(self, address: str, raw_data: bytes):
+        """Scanner callback: capture, match and queue one advertisement"""
+        received_at = time.time()
+        if logger.isEnabledFor(logging.INFO):
+            suppressed = self.discovery_log.allow(address, received_at)
+            if suppressed is not None:
+                logger.info("Discovered device: %s (%d advertisements suppressed since last logged)",
+                            address, suppressed, extra={'address': address})
+        metrics.ADVERTISEMENTS_SEEN.inc()
+        if self.capture:
+            self.capture.write(received_at, address, raw_data)
+        advertisement = self.match_advertisement(address, raw_data, received_at)
+        if advertisement and self.poll_interval <= 0:
+            self.enqueue_advertisement(advertisement)
+    
+    def match_advertisement(self, address: str, raw_data: bytes, received_at: float) -> Optional[Advertisement]:
+        """Match an advertisement against the registry by normalized address"""
+        try:
+            config = self.registry.get_device(address, raw_data)
+        except Exception as e:
+            logger.debug("Device %s not matching: %s", address, e)
+            return None
+        if not config:
+            return None
+        if self.watchdog:
+            self.watchdog.seen(config.canonical)
+        if self.registry.is_repeat(config, raw_data):
+            metrics.ADVERTISEMENTS_REPEATED.inc()
+            return None
+        logger.debug("Found matching device: %s (%s)", config.name, address)
+        metrics.ADVERTISEMENTS_MATCHED.inc()
+        advertisement = Advertisement(received_at, address, raw_data)
+        self.latest_advertisements[config.canonical] = advertisement  # Used by polling mode
+        self.device_found.set()
+        return advertisement
+    
+    async def replay_advertisements(self):
+        """Feed a capture file through the pipeline in place of the scanner"""
+        from capture import replay_capture
+        logger.info(f"Replaying advertisements from {self.replay_file} at speed {self.replay_speed}")
+        count = 0
+        async for received_at, address, raw_data in replay_capture(self.replay_file, self.replay_speed):
+            metrics.ADVERTISEMENTS_SEEN.inc()
+            advertisement = self.match_advertisement(address, raw_data, received_at)
+            if advertisement and self.poll_interval <= 0:
+                # Unlike the live scanner, a replay waits for each advertisement to be processed and
+                # for its messages to be taken up by the publisher instead of dropping
+                await self.advertisements.put(advertisement)
+                await self.advertisements.join()
+                await self.publisher.wait_writable()
+            self.replay_clock = received_at
+            count += 1
+        logger.info(f"Replay finished after {count} advertisements")
+    
+    async def stop_scanner(self):
+        if self.scanner:
+            try:
+                # A wedged BlueZ may never answer; the scanner is abandoned then
+                await asyncio.wait_for(self.scanner.stop(), SCANNER_START_TIMEOUT)
+            except Exception as e:
+                logger.error(f"Error stopping scanner: {e}")
+            self.scanner = None
+    
+    def enqueue_advertisement(self, advertisement: Advertisement):
+        """Hand an advertisement to the decode pipeline, dropping the oldest one when full"""
+        if self.advertisements.full():
+            self.advertisements.get_nowait()
+            self.advertisements.task_done()
+            metrics.ADVERTISEMENTS_DROPPED.inc()
+            logger.warning("Advertisement queue full, dropping oldest advertisement")
+        self.advertisements.put_nowait(advertisement)
+    
     def setup_mqtt(self):
-        self.mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-        self.mqtt_client.username_pw_set(self.mqtt_user, self.mqtt_password)
-        
-        def on_connect(client, userdata, flags, rc, properties):
-            if rc == 0:
-                logger.info("Connected to MQTT broker")
-            else:
-                logger.error(f"Failed to connect to MQTT broker: {rc}")
-        
-        def on_disconnect(client, userdata, flags, rc, properties):
-            logger.info("Disconnected from MQTT broker")
-        
-        self.mqtt_client.on_connect = on_connect
-        self.mqtt_client.on_disconnect = on_disconnect
+        """Start the asyncio publisher; it connects and reconnects in the background"""
+        self.publisher = AsyncMQTTPublisher(
+            self.mqtt_host,
+            self.mqtt_port,
+            username=self.mqtt_user,
+            password=self.mqtt_password,
+            qos=self.mqtt_qos,
+            max_inflight=self.mqtt_max_inflight,
+            queue_size=self.mqtt_queue_size,
+            protocol=self.mqtt_protocol,
+            topic_aliases=self.mqtt_topic_aliases,
+            keepalive=self.mqtt_keepalive,
+            ack_timeout=self.mqtt_ack_timeout,
+            max_reconnect_delay=self.mqtt_reconnect_max,
+        )
+        metrics.MQTT_CONNECTED.set_function(lambda: int(self.publisher.connected.is_set()))
+        metrics.MQTT_QUEUE_DEPTH.set_function(lambda: self.publisher.backlog)
+        if self.discovery:
+            self.publisher.subscribe(self.discovery.birth_topic, self.discovery.on_birth)
+        if self.central:
+            self.publisher.subscribe(f"{self.gateway_topic}/+", self.on_gateway_payload)
+        self.publisher.start()
         
+        if self.offline_queue_dir:
+            self.offline_queue = OfflineQueue(self.offline_queue_dir, max_bytes=self.offline_queue_max_mb << 20)
+            metrics.OFFLINE_QUEUE_DEPTH.set_function(lambda: len(self.offline_queue))
+    
+    def on_gateway_payload(self, payload: bytes):
+        """A raw advertisement forwarded by a scanner gateway"""
         try:
-            self.mqtt_client.connect(self.mqtt_host, 1883, 60)
-            self.mqtt_client.loop_start()
-        except Exception as e:
-            logger.error(f"Error connecting to MQTT: {e}")
-            raise
+            frame = decode_frame(payload)
+        except (ValueError, struct.error) as e:
+            logger.warning(f"Ignoring malformed gateway frame: {e}")
+            return
+        metrics.GATEWAY_FRAMES.inc()
+        self.gateway_dedup.add(frame)
+    
+    def on_gateway_frame(self, frame: GatewayFrame, copies: int):
+        """Best-RSSI copy of an advertisement heard by `copies` gateways"""
+        metrics.GATEWAY_DUPLICATES.inc(copies - 1)
+        metrics.ADVERTISEMENTS_SEEN.inc()
+        logger.debug("Advertisement from %s via %s (%d dBm, %d gateways)", frame.address, frame.gateway, frame.rssi, copies)
+        if self.capture:
+            self.capture.write(frame.received_at, frame.address, frame.raw_data)
+        advertisement = self.match_advertisement(frame.address, frame.raw_data, frame.received_at)
+        if advertisement and self.poll_interval <= 0:
+            self.enqueue_advertisement(advertisement)
     
-    async def read_mppt_data(self) -> Optional[Dict[str, Any]]:
-        if not self.device or not hasattr(self, 'raw_data'):
-            logger.error("No device connection or raw data available")
+    async def read_mppt_data(self, advertisement: Advertisement) -> Optional[Reading]:
+        config = self.registry.lookup(advertisement.address)
+        if not config or not config.device:
+            logger.error(f"No device connection available for {advertisement.address}")
             return None
         
         try:
             # Parse the raw advertisement data
-            parsed_data = self.device.parse(self.raw_data)
+            started = time.perf_counter()
+            parsed_data = config.device.parse(advertisement.raw_data)
+            decoded = time.perf_counter()
+            metrics.DECODE_SECONDS.observe(decoded - started)
             if parsed_data:
-                logger.info("Successfully read MPPT data")
-                logger.debug(f"Parsed data type: {type(parsed_data)}")
-                logger.debug(f"Parsed data attributes: {[attr for attr in dir(parsed_data) if not attr.startswith('_')]}")
-                
-                # Convert the parsed data object to dictionary
-                data_dict = {}
-                for attr_name in dir(parsed_data):
-                    if not attr_name.startswith('_'):
-                        attr_value = getattr(parsed_data, attr_name)
-                        if callable(attr_value) and attr_name.startswith('get_'):
-                            # Call the getter method to get the actual value
-                            try:
-                                value = attr_value()
-                                field_name = attr_name[4:]  # Remove 'get_' prefix
-                                # Convert enum values to strings for JSON serialization
-                                if hasattr(value, 'name'):
-                                    value = value.name  # Use enum name (e.g., 'FLOAT' instead of OperationMode.FLOAT)
-                                elif hasattr(value, 'value'):
-                                    value = value.value  # Use enum value if no name
-                                data_dict[field_name] = value
-                                logger.debug(f"  {field_name}: {value}")
-                            except Exception as e:
-                                logger.debug(f"  Error calling {attr_name}: {e}")
-                        elif not callable(attr_value):
-                            # Include non-callable attributes
-                            data_dict[attr_name] = attr_value
-                            logger.debug(f"  {attr_name}: {attr_value}")
-                
-                return {
-                    'timestamp': datetime.now().isoformat(),
-                    **data_dict  # Include all parsed data fields
-                }
+                logger.debug("Decoded reading from %s", config.name)
+                # Convert the parsed data object to a reading record using the extractor cached for its class
+                reading = extract_reading(parsed_data, int(advertisement.received_at * 1000))
+                metrics.EXTRACT_SECONDS.observe(time.perf_counter() - decoded)
+                metrics.READINGS_DECODED.inc()
+                return reading
             return None
         except Exception as e:
+            metrics.DECODE_ERRORS.inc()
             logger.error(f"Error reading MPPT data: {e}")
             return None
     
-    def publish_to_mqtt(self, data: Dict[str, Any]):
-        if not self.mqtt_client or not data:
+    def buffer_offline(self, topic: str, data_json: str) -> bool:
+        """Append to the offline queue, for replay to {topic}/history, if the broker is unreachable"""
+        if (self.offline_queue is None or self.publisher.connected.is_set()
+                or not (self.publisher.connections or time.time() - metrics.PROCESS_START_TIME > self.mqtt_startup_grace)):
+            return False
+        self.offline_queue.append(f'{{"topic": {json.dumps(topic)}, "data": {data_json}}}'.encode())
+        metrics.READINGS_BUFFERED.inc()
+        logger.debug("Broker unreachable, buffered %s (%d queued)", topic, len(self.offline_queue))
+        return True
+    
+    def pipeline_time(self, data: Reading) -> float:
+        """Clock for publish scheduling: the reading's capture time during a replay, monotonic otherwise"""
+        return data.timestamp_ms / 1000 if self.replay_file else time.monotonic()
+    
+    def publish_to_mqtt(self, data: Reading, base_topic: str = "homeassistant/victron"):
+        if not self.publisher or not data:
             return
         
-        base_topic = "homeassistant/victron"
+        if self.buffer_offline(base_topic, data.to_json()):
+            return
         
+        now = self.pipeline_time(data)
+        published = 0
         for key, value in data.items():
-            if value is not None:
-                topic = f"{base_topic}/{key}"
-                payload = json.dumps(value) if not isinstance(value, (int, float, str)) else str(value)
-                
-                try:
-                    result = self.mqtt_client.publish(topic, payload, retain=True)
-                    if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                        logger.debug(f"Published {key}: {payload}")
-                    else:
-                        logger.warning(f"Failed to publish {key}")
-                except Exception as e:
-                    logger.error(f"Error publishing {key}: {e}")
+            if value is None or key == 'timestamp':
+                continue
+            topic = f"{base_topic}/{key}"
+            if self.change_filter and not self.change_filter.changed(topic, key, value, now):
+                continue
+            if self._publish_value(topic, key, value):
+                published += 1
+                if self.change_filter:
+                    self.change_filter.mark_published(topic, value, now)
         
         full_data_topic = f"{base_topic}/all"
-        full_payload = json.dumps(data)
+        if self.change_filter and not published and not self.change_filter.due(full_data_topic, now):
+            logger.debug("No changes to publish")
+            return
+        
+        # The timestamp travels with every batch of changed values
+        self._publish_value(f"{base_topic}/timestamp", 'timestamp', data.timestamp)
+        
+        if self.compact_encoder:
+            full_payload, schema = self.compact_encoder.encode(base_topic, data)
+            if schema is not None:
+                self.publisher.publish(f"{base_topic}/schema", schema.to_json(), retain=True)
+        else:
+            full_payload = data.to_json()
+        on_sent = None if self.first_published.is_set() else self.first_published.set
+        self.publisher.publish(full_data_topic, full_payload, retain=True, on_sent=on_sent)
+        if self.change_filter:
+            self.change_filter.mark_published(full_data_topic, None, now)
+        logger.debug("Queued %d changed values and complete data for %s", published, base_topic)
+    
+    def _publish_value(self, topic: str, key: str, value: Any) -> bool:
         try:
-            self.mqtt_client.publish(full_data_topic, full_payload, retain=True)
-            logger.info("Published complete data to MQTT")
-        except Exception as e:
-            logger.error(f"Error publishing full data: {e}")
+            payload = json.dumps(value) if not isinstance(value, (int, float, str)) else str(value)
+        except (TypeError, ValueError) as e:
+            logger.error(f"Error serializing {key}: {e}")
+            return False
+        self.publisher.publish(topic, payload, retain=True)
+        logger.debug("Queued %s: %s", key, payload)
+        return True
     
     async def run(self):
         logger.info("Starting Victron MPPT MQTT Publisher")
         
+        # The broker handshake runs in the background while the servers start and bleak loads
         self.setup_mqtt()
+        if self.metrics_port:
+            self.metrics_server = metrics.MetricsServer(self.metrics_host, self.metrics_port)
+            await self.metrics_server.start()
+        if self.latest:
+            from latest_cache import LatestValueServer
+            self.live_server = LatestValueServer(self.latest, self.live_host, self.live_port, self.live_max_clients)
+            await self.live_server.start()
         
-        connected = await self.connect_to_mppt()
-        if not connected:
-            logger.error("Could not connect to MPPT device")
-            return
-        
+        startup_report = asyncio.create_task(self.report_startup())
+        background_tasks = []
+        if self.offline_queue is not None:
+            background_tasks.append(asyncio.create_task(self.replay_offline_queue()))
+        if self.aggregator:
+            background_tasks.append(asyncio.create_task(self.expire_aggregation_windows()))
+        # The consumer is running before the scan starts, so the first advertisement is published as it arrives
+        consumer = asyncio.create_task(self.poll_loop() if self.poll_interval > 0 else self.stream_loop())
+        background_tasks.append(consumer)
         try:
-            while True:
-                data = await self.read_mppt_data()
-                if data:
-                    self.publish_to_mqtt(data)
-                else:
-                    logger.warning("No data received from MPPT")
-                
-                await asyncio.sleep(30)
+            if self.replay_file or self.central:
+                try:
+                    await asyncio.wait_for(self.publisher.connected.wait(), timeout=self.scan_timeout)
+                except asyncio.TimeoutError:
+                    logger.warning("MQTT broker not connected yet, readings will be buffered")
+            elif not await self.connect_to_mppt():
+                if not self.watchdog:
+                    logger.error("Could not connect to MPPT device")
+                    return
+                logger.warning("No device heard yet, the scanner watchdog keeps retrying")
+            if self.watchdog:
+                background_tasks.append(asyncio.create_task(self.watchdog.run()))
+            
+            if self.replay_file:
+                await self.replay_advertisements()
+                await self.advertisements.join()
+            else:
+                await consumer
                 
         except KeyboardInterrupt:
             logger.info("Shutting down...")
         except Exception as e:
             logger.error(f"Unexpected error: {e}")
         finally:
-            if self.mqtt_client:
-                self.mqtt_client.loop_stop()
-                self.mqtt_client.disconnect()
+            for task in background_tasks:
+                task.cancel()
+            await self.stop_scanner()
+            if self.publisher:
+                await self.publisher.stop()
+            # Cancelled only now: the flush above may deliver the first reading
+            startup_report.cancel()
+            if self.offline_queue is not None:
+                self.offline_queue.close()
+            if self.timeseries:
+                self.timeseries.close()
+            if self.derived:
+                self.derived.close()
+            if self.capture:
+                self.capture.close()
+            if self.metrics_server:
+                await self.metrics_server.stop()
+            if self.live_server:
+                await self.live_server.stop()
+    
+    async def report_startup(self):
+        """Log and export how long it took from process start to the first acknowledged reading"""
+        started = metrics.PROCESS_START_TIME
+        
+        async def reached(event: asyncio.Event) -> float:
+            await event.wait()
+            return time.time() - started
+        
+        connected, advertised, published = await asyncio.gather(
+            reached(self.publisher.connected), reached(self.device_found), reached(self.first_published))
+        metrics.TIME_TO_FIRST_PUBLISH.set(published)
+        logger.info(f"First reading published {published:.2f}s after process start (imports done after "
+                    f"{IMPORTED_AT - started:.2f}s, MQTT connected after {connected:.2f}s, "
+                    f"first advertisement after {advertised:.2f}s)")
+    
+    async def stream_loop(self):
+        """Decode and publish every advertisement as soon as it arrives"""
+        while True:
+            advertisement = await self.advertisements.get()
+            started = time.perf_counter()
+            try:
+                await self.process_advertisement(advertisement)
+                metrics.PROCESS_SECONDS.observe(time.perf_counter() - started)
+            except Exception as e:
+                logger.error(f"Error processing advertisement from {advertisement.address}: {e}")
+            finally:
+                self.advertisements.task_done()
+    
+    async def poll_loop(self):
+        """Publish the most recent advertisement of each device every poll_interval seconds"""
+        await self.device_found.wait()
+        last_published: Dict[str, Advertisement] = {}
+        while True:
+            for config in self.registry:
+                advertisement = self.latest_advertisements.get(config.canonical)
+                if advertisement is not None and advertisement is not last_published.get(config.canonical):
+                    last_published[config.canonical] = advertisement
+                    await self.process_advertisement(advertisement)
+                else:
+                    logger.warning(f"No new data received from {config.name}")
+            
+            await asyncio.sleep(self.poll_interval)
+    
+    async def replay_offline_queue(self):
+        """Replay buffered readings in rate-limited batches whenever the broker is reachable"""
+        while True:
+            await self.publisher.connected.wait()
+            batch = self.offline_queue.peek(self.offline_replay_batch)
+            if not batch:
+                await asyncio.sleep(1)
+                continue
+            
+            sends = []
+            for record in batch:
+                entry = json.loads(record)
+                sends.append(self.publisher.deliver(f"{entry['topic']}/history", json.dumps(entry['data'])))
+            results = await asyncio.gather(*sends)
+            # Only consume the leading run of delivered records so nothing is skipped
+            delivered = next((i for i, ok in enumerate(results) if not ok), len(results))
+            self.offline_queue.commit(delivered)
+            logger.info(f"Replayed {delivered} buffered readings ({len(self.offline_queue)} left)")
+            
+            await asyncio.sleep(len(batch) / self.offline_replay_rate)
+    
+    async def process_advertisement(self, advertisement: Advertisement):
+        """Decode one advertisement and publish it under its device's topic tree"""
+        config = self.registry.lookup(advertisement.address)
+        if not config:
+            return
+        data = await self.read_mppt_data(advertisement)
+        if not data:
+            return
+        if self.derived:
+            derived, rollup = self.derived.update(config.canonical, data, data.timestamp_ms)
+            data = data.with_fields(derived)
+            if rollup:
+                self.publish_daily(config, rollup)
+        if self.unmatched_deadbands:
+            self.check_deadbands(config, data)
+        if self.latest:
+            self.latest.update(config.name, data)
+        if self.timeseries:
+            try:
+                self.timeseries.append(config.canonical, advertisement.received_at, data)
+            except OSError as e:
+                logger.error(f"Error writing time-series data: {e}")
+        if self.aggregator:
+            summary = self.aggregator.add(config.canonical, data, advertisement.received_at)
+            if summary:
+                self.publish_aggregate(config, summary)
+        else:
+            if self.scheduler and not self.scheduler.should_publish(config.canonical, data, self.pipeline_time(data)):
+                return
+            self.publish_discovery(config, data)
+            self.publish_to_mqtt(data, config.topic_prefix)
+    
+    def check_deadbands(self, config: DeviceConfig, data: Reading):
+        """Warn once every device has reported if some DEADBANDS metrics match no decoded field"""
+        self.decoded_fields.update(data.layout.fields)
+        self.unmatched_deadbands.difference_update(data.layout.fields)
+        self.devices_reported.add(config.canonical)
+        if self.unmatched_deadbands and len(self.devices_reported) >= len(self.registry):
+            logger.warning(f"DEADBANDS metrics {', '.join(sorted(self.unmatched_deadbands))} match no decoded field "
+                           f"and have no effect (fields: {', '.join(sorted(self.decoded_fields))})")
+            self.unmatched_deadbands.clear()
+    
+    def publish_aggregate(self, config: DeviceConfig, summary: Dict[str, Any]):
+        """Publish a closed window: its last reading on the usual topics plus one aggregate message"""
+        latest = summary.pop('latest')
+        self.publish_discovery(config, latest)
+        self.publish_to_mqtt(latest, config.topic_prefix)
+        if not self.publisher:
+            return
+        # Like readings, a closed window is buffered while the broker is away rather than lost
+        topic = f"{config.topic_prefix}/aggregate"
+        payload = json.dumps(summary, separators=(',', ':'))
+        if not self.buffer_offline(topic, payload):
+            self.publisher.publish(topic, payload, retain=True)
+        logger.debug("Queued %d-sample aggregate for %s", summary['samples'], config.name)
+    
+    def publish_daily(self, config: DeviceConfig, rollup: Dict[str, Any]):
+        """Publish the derived totals of a finished day"""
+        if self.publisher:
+            self.publisher.publish(f"{config.topic_prefix}/daily", json.dumps(rollup, separators=(',', ':')), retain=True)
+            logger.info(f"Published daily totals of {rollup['date']} for {config.name}")
+    
+    async def expire_aggregation_windows(self):
+        """Close windows of devices that went quiet instead of waiting for their next reading"""
+        while True:
+            await asyncio.sleep(min(self.aggregation_window, 1.0))
+            # Replayed readings keep their capture timestamps, so a replay's windows follow its own clock
+            now = self.replay_clock if self.replay_file else time.time()
+            if now is None:
+                continue
+            for canonical, summary in self.aggregator.expire(now):
+                config = self.registry.lookup(canonical)
+                if config:
+                    self.publish_aggregate(config, summary)
+    
+    def publish_discovery(self, config: DeviceConfig, data: Reading):
+        if not self.discovery or not self.publisher or not self.publisher.connected.is_set():
+            return
+        messages = self.discovery.pending(config, data)
+        if not messages:
+            return
+        for topic, payload in messages:
+            self.publisher.publish(topic, payload, retain=True)
+        self.discovery.mark_announced(config)
+        # Values published before the sensors existed would be missing in HA
+        if self.change_filter:
+            self.change_filter.forget(config.topic_prefix + '/')
+        logger.info(f"Published {len(messages)} discovery configs for {config.name}")
+
+
+async def run_gateway():
+    """Scanner-only node: forward raw advertisements to a central decoder, no keys needed"""
+    publisher = AsyncMQTTPublisher(
+        os.getenv('MQTT_HOST'),
+        int(os.getenv('MQTT_PORT', '1883')),
+        username=os.getenv('MQTT_USER'),
+        password=os.getenv('MQTT_PASSWORD'),
+        qos=int(os.getenv('GATEWAY_QOS', '0')),
+        queue_size=int(os.getenv('MQTT_QUEUE_SIZE', '1000')),
+    )
+    addresses = {normalize_address(a) for a in os.getenv('GATEWAY_ADDRESSES', '').split(',') if a.strip()}
+    adapters = [a.strip() for a in os.getenv('ADAPTERS', '').split(',') if a.strip()]
+    gateway = ScannerGateway(
+        publisher,
+        os.getenv('GATEWAY_ID') or socket.gethostname(),
+        os.getenv('GATEWAY_TOPIC', DEFAULT_RAW_TOPIC),
+        addresses or None,
+        adapters or None,
+    )
+    publisher.start()
+    try:
+        await gateway.run()
+    finally:
+        await publisher.stop()
 
 
 async def main():
+    # systemd stops the service with SIGTERM; cancelling runs the same cleanup as Ctrl+C, so open
+    # time-series blocks, the derived-metrics checkpoint and the capture buffer reach the disk
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    if os.getenv('GATEWAY_MODE', '').lower() == 'gateway':
+        try:
+            await run_gateway()
+        except asyncio.CancelledError:
+            logger.info("Stopped")
+        except Exception as e:
+            logger.error(f"Gateway error: {e}")
+        return
     try:
         reader = VictronMPPTReader()
         await reader.run()
+    except asyncio.CancelledError:
+        logger.info("Stopped")
     except ValueError as e:
         logger.error(f"Configuration error: {e}")
         logger.error("Please set the following environment variables:")
         logger.error("- MPPT_MAC_ADDRESS (device identifier, e.g., '763aeff5-1334-e64a-ab30-a0f478s20fe1')")
         logger.error("- ENCRYPTION_KEY (32-character hex key)")
+        logger.error("  or DEVICES_CONFIG (path to a JSON device list) instead of the two above")
         logger.error("- MQTT_USER")
         logger.error("- MQTT_PASSWORD")
     except Exception as e:
@@ -226,4 +770,7 @@ async def main():
 
 
 if __name__ == "__main__":
+    # LOG_LEVEL defaults to INFO; LOG_FORMAT=json writes one JSON object per line for log shippers.
+    # Configured here rather than on import, so the benchmark and test client keep their own setup
+    configure_logging(os.getenv('LOG_LEVEL', 'INFO'), os.getenv('LOG_FORMAT', 'text'))
     asyncio.run(main())
@@ -0,0 +1,210 @@
+"""
+Low-overhead counters, gauges and histograms exposed in the Prometheus text format
+"""
+import asyncio
+import bisect
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Seconds; decode and publish latencies span tens of microseconds to seconds
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.value}"]
+
+
+class Gauge:
+    """A value that is set directly, or read from a callback at scrape time"""
+    __slots__ = ('name', 'help', 'value', 'function')
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, function: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.function = function
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Optional[Callable[[], float]]):
+        self.function = function
+
+    def samples(self) -> List[str]:
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                logger.debug(f"Gauge {self.name} callback failed: {e}")
+        return [f"{self.name} {value}"]
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is a bisect and two additions"""
+    __slots__ = ('name', 'help', 'buckets', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, object] = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help))
+
+    def gauge(self, name: str, help: str, function: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, help, function))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, buckets))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+def _resident_memory() -> float:
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _process_start_time() -> float:
+    """When the kernel started this process, so interpreter startup and imports count too"""
+    try:
+        with open('/proc/self/stat') as f:
+            # Field 22 (starttime, clock ticks after boot); the command name before it may contain spaces
+            ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        return time.time() - time.clock_gettime(time.CLOCK_BOOTTIME) + ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.time()
+
+
+REGISTRY = Registry()
+
+ADVERTISEMENTS_SEEN = REGISTRY.counter('victron_advertisements_seen_total', 'Victron BLE advertisements received')
+ADVERTISEMENTS_MATCHED = REGISTRY.counter('victron_advertisements_matched_total', 'Advertisements from configured devices')
+ADVERTISEMENTS_REPEATED = REGISTRY.counter('victron_advertisements_repeated_total', 'Repeated frames skipped before decryption')
+ADVERTISEMENTS_DROPPED = REGISTRY.counter('victron_advertisements_dropped_total', 'Advertisements dropped because the pipeline queue was full')
+GATEWAY_FRAMES = REGISTRY.counter('victron_gateway_frames_total', 'Raw advertisements received from scanner gateways')
+GATEWAY_DUPLICATES = REGISTRY.counter('victron_gateway_duplicates_total', 'Gateway copies merged into a better-RSSI copy of the same advertisement')
+ADAPTER_FAILOVERS = REGISTRY.counter('victron_adapter_failovers_total', 'Devices moved to another BLE adapter after theirs stopped hearing them')
+READINGS_DECODED = REGISTRY.counter('victron_readings_decoded_total', 'Advertisements decrypted and parsed into readings')
+DECODE_ERRORS = REGISTRY.counter('victron_decode_errors_total', 'Advertisements that failed to decrypt or parse')
+DECODE_SECONDS = REGISTRY.histogram('victron_decode_seconds', 'Time to decrypt and parse one advertisement')
+EXTRACT_SECONDS = REGISTRY.histogram('victron_extract_seconds', 'Time to turn a parsed reading into a Reading record')
+PROCESS_SECONDS = REGISTRY.histogram('victron_process_seconds', 'Time from dequeue to published or buffered reading')
+READINGS_BUFFERED = REGISTRY.counter('victron_readings_buffered_total', 'Readings written to the offline queue while the broker was away')
+MQTT_PUBLISH_SECONDS = REGISTRY.histogram('victron_mqtt_publish_seconds', 'Time from queueing an MQTT message to the broker acknowledging it')
+MQTT_ACKS = REGISTRY.counter('victron_mqtt_acks_total', 'MQTT publishes acknowledged by the broker')
+MQTT_FAILURES = REGISTRY.counter('victron_mqtt_publish_failures_total', 'MQTT publishes that failed and were retried or dropped')
+MQTT_DROPPED = REGISTRY.counter('victron_mqtt_dropped_total', 'MQTT messages dropped because the publish queue was full')
+MQTT_RECONNECTS = REGISTRY.counter('victron_mqtt_reconnects_total', 'MQTT sessions re-established after the first one')
+MQTT_CONNECTED = REGISTRY.gauge('victron_mqtt_connected', 'Whether the broker connection is up')
+MQTT_QUEUE_DEPTH = REGISTRY.gauge('victron_mqtt_queue_depth', 'Messages waiting in the MQTT publish queue')
+SCANNER_RESTARTS = REGISTRY.counter('victron_scanner_restarts_total', 'In-process scanner restarts by the watchdog')
+SECONDS_SINCE_ADVERTISEMENT = REGISTRY.gauge('victron_seconds_since_advertisement', 'Seconds since any configured device was last heard')
+ADVERTISEMENT_QUEUE_DEPTH = REGISTRY.gauge('victron_advertisement_queue_depth', 'Advertisements waiting to be decoded')
+OFFLINE_QUEUE_DEPTH = REGISTRY.gauge('victron_offline_queue_depth', 'Readings waiting in the offline queue')
+LIVE_CLIENTS = REGISTRY.gauge('victron_live_clients', 'WebSocket clients connected to the latest-value stream')
+REGISTRY.gauge('victron_process_resident_memory_bytes', 'Resident set size of the process', _resident_memory)
+TIME_TO_FIRST_PUBLISH = REGISTRY.gauge('victron_time_to_first_publish_seconds', 'Seconds from process start until the broker acknowledged the first reading')
+PROCESS_START_TIME = _process_start_time()
+REGISTRY.gauge('victron_process_start_time_seconds', 'Start time of the process since the epoch', lambda: PROCESS_START_TIME)
+
+
+class MetricsServer:
+    """Serves REGISTRY on GET /metrics over a plain asyncio socket server"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9101, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self._server: Optional[asyncio.base_events.Server] = None
+
+    async def start(self) -> int:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+        return self.port
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            method, path = request.split(b' ', 2)[:2]
+            if method != b'GET':
+                status, body = '405 Method Not Allowed', b''
+            elif path.split(b'?')[0] == b'/metrics':
+                status, body = '200 OK', self.registry.render().encode()
+            else:
+                status, body = '404 Not Found', b''
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
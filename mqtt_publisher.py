@@ -0,0 +1,472 @@
+"""
+Asyncio MQTT publisher sharing the event loop with the BLE scanner
+"""
+import asyncio
+import logging
+import socket
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Set, Union
+
+import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+from backoff import JitteredBackoff
+import metrics
+
+logger = logging.getLogger(__name__)
+
+PROTOCOLS = {'3.1.1': mqtt.MQTTv311, '5': mqtt.MQTTv5}
+# Holds back partial TCP segments while a batch is written (Linux only)
+TCP_CORK = getattr(socket, 'TCP_CORK', None)
+
+
+class MqttError(Exception):
+    """The broker session failed or was lost"""
+
+
+class _TopicAlias(Properties):
+    """PUBLISH properties carrying only a topic alias, packed once instead of on every publish"""
+
+    def __init__(self, alias: int):
+        super().__init__(PacketTypes.PUBLISH)
+        self.TopicAlias = alias
+        # Properties only accepts MQTT property names as attributes
+        object.__setattr__(self, '_packed', super().pack())
+
+    def pack(self) -> bytes:
+        return self._packed
+
+
+class LoopClient:
+    """paho-mqtt client driven by the asyncio event loop instead of a network thread.
+
+    paho reports its socket through callbacks; the socket is registered with
+    the loop's reader/writer callbacks and keepalives run in a small task.
+    Only the blocking TCP connect runs in the default executor.
+
+    Publishes queued during one loop iteration leave in a single corked
+    write. With MQTT 5, up to `topic_aliases` topics (capped by the broker's
+    Topic Alias Maximum) are sent in full once and by alias afterwards.
+    """
+
+    def __init__(self, host: str, port: int = 1883, username: Optional[str] = None,
+                 password: Optional[str] = None, max_inflight: int = 20, keepalive: int = 60,
+                 on_message: Optional[Callable[[str, bytes], None]] = None,
+                 protocol: int = mqtt.MQTTv311, topic_aliases: int = 0):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.topic_aliases = topic_aliases if protocol == mqtt.MQTTv5 else 0
+        self._aliases: Dict[str, _TopicAlias] = {}
+        self._alias_maximum = 0
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._on_message = on_message
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._early_acks: Set[int] = set()
+        self._connected: asyncio.Future = self._loop.create_future()
+        self.lost: asyncio.Future = self._loop.create_future()
+        self._misc: Optional[asyncio.Task] = None
+
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, protocol=protocol)
+        if username:
+            client.username_pw_set(username, password)
+        client.max_inflight_messages_set(max_inflight)
+        client.on_socket_open = self._on_socket_open
+        client.on_socket_close = self._on_socket_close
+        client.on_socket_register_write = self._on_socket_register_write
+        client.on_socket_unregister_write = self._on_socket_unregister_write
+        client.on_connect = self._handle_connect
+        client.on_disconnect = self._handle_disconnect
+        client.on_publish = self._handle_publish
+        client.on_message = self._handle_message
+        self._client = client
+
+    async def connect(self, timeout: float = 10.0):
+        await self._loop.run_in_executor(None, self._client.connect, self.host, self.port, self.keepalive)
+        await asyncio.wait_for(asyncio.shield(self._connected), timeout)
+
+    async def publish(self, topic: str, payload: Union[str, bytes], qos: int = 0, retain: bool = False):
+        """Publish and wait for the broker's acknowledgement (or the write, for QoS 0)"""
+        await self.publish_nowait(topic, payload, qos, retain)
+
+    def publish_nowait(self, topic: str, payload: Union[str, bytes], qos: int = 0,
+                       retain: bool = False) -> asyncio.Future:
+        """Queue a publish for the next write; the future resolves on the acknowledgement"""
+        properties = None
+        if self._alias_maximum:
+            properties = self._aliases.get(topic)
+            if properties is not None:
+                # The broker already knows this alias; send it instead of the topic
+                topic = ''
+            elif len(self._aliases) < self._alias_maximum:
+                properties = self._aliases[topic] = _TopicAlias(len(self._aliases) + 1)
+        info = self._client.publish(topic, payload, qos=qos, retain=retain, properties=properties)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise MqttError(mqtt.error_string(info.rc))
+        future = self._loop.create_future()
+        if info.mid in self._early_acks:
+            self._early_acks.discard(info.mid)
+            future.set_result(None)
+        else:
+            self._pending[info.mid] = future
+        return future
+
+    def subscribe(self, topic: str, qos: int = 0):
+        result, _ = self._client.subscribe(topic, qos)
+        if result != mqtt.MQTT_ERR_SUCCESS:
+            raise MqttError(mqtt.error_string(result))
+
+    async def disconnect(self, timeout: float = 2.0):
+        if not self.lost.done():
+            if self._client.is_connected():
+                self._client.disconnect()
+                try:
+                    await asyncio.wait_for(asyncio.shield(self.lost), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            if not self.lost.done():
+                # Never connected, or the peer vanished without closing: stop watching the socket ourselves
+                sock = self._client.socket()
+                if sock is not None:
+                    self._loop.remove_reader(sock)
+                    self._loop.remove_writer(sock)
+                    sock.close()
+        # Publishes still awaiting an acknowledgement will not get one on this session
+        self._lose(MqttError("Disconnected"))
+        if not self._connected.cancelled():
+            self._connected.exception()  # Nobody waits for this session's CONNACK any more
+        if self._misc:
+            self._misc.cancel()
+
+    def _call_on_loop(self, callback: Callable, *args):
+        # connect() runs in an executor thread; loop registrations must not
+        if threading.get_ident() == self._loop_thread:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._call_on_loop(self._register, sock)
+
+    def _register(self, sock):
+        self._loop.add_reader(sock, self._client.loop_read)
+        self._misc = self._loop.create_task(self._misc_loop())
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._call_on_loop(self._loop.remove_reader, sock)
+        self._call_on_loop(self._loop.remove_writer, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._call_on_loop(self._loop.add_writer, sock, self._write, sock)
+
+    def _write(self, sock):
+        # Corking turns the batch of small MQTT packets into full TCP segments
+        if TCP_CORK is None:
+            self._client.loop_write()
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 1)
+        try:
+            self._client.loop_write()
+        finally:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, TCP_CORK, 0)
+            except OSError:
+                # loop_write closed the socket after a failed write
+                pass
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._call_on_loop(self._loop.remove_writer, sock)
+
+    async def _misc_loop(self):
+        while self._client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+    def _resolve(self, future: asyncio.Future, error: Optional[Exception] = None):
+        if not future.done():
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(None)
+
+    def _handle_connect(self, client, userdata, flags, reason_code, properties):
+        error = MqttError(f"Connection refused: {reason_code}") if reason_code.is_failure else None
+        if self.topic_aliases:
+            self._alias_maximum = min(self.topic_aliases, getattr(properties, 'TopicAliasMaximum', 0))
+        self._call_on_loop(self._resolve, self._connected, error)
+
+    def _handle_disconnect(self, client, userdata, flags, reason_code, properties):
+        self._call_on_loop(self._lose, MqttError(f"Disconnected: {reason_code}"))
+
+    def _lose(self, error: MqttError):
+        self._resolve(self._connected, error)
+        self._resolve(self.lost)
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            self._resolve(future, error)
+
+    def _handle_publish(self, client, userdata, mid, reason_code, properties):
+        future = self._pending.pop(mid, None)
+        if future is None:
+            # Acknowledged before publish() got to wait for it
+            self._early_acks.add(mid)
+        elif reason_code.is_failure:
+            self._resolve(future, MqttError(f"Publish rejected: {reason_code}"))
+        else:
+            self._resolve(future)
+
+    def _handle_message(self, client, userdata, message):
+        if self._on_message:
+            self._on_message(message.topic, message.payload)
+
+
+class OutgoingMessage(NamedTuple):
+    topic: str
+    payload: Union[str, bytes]
+    retain: bool = True
+    queued_at: float = 0.0  # time.monotonic() when publish() accepted it
+    on_sent: Optional[Callable[[], None]] = None  # Called once the broker acknowledged it
+
+
+class AsyncMQTTPublisher:
+    """Bounded outgoing queue drained by a window of in-flight publishes.
+
+    publish() never blocks: when the broker is slow or away the queue fills
+    up and the oldest messages are dropped, so advertisement handling on the
+    same event loop is never stalled. Each drain pass hands every message the
+    window allows to the client at once, so a reading's messages share one
+    socket write, and acknowledgements are tracked with future callbacks.
+    """
+
+    def __init__(self, host: str, port: int = 1883, username: Optional[str] = None,
+                 password: Optional[str] = None, qos: int = 1, max_inflight: int = 20,
+                 queue_size: int = 1000, reconnect_delay: float = 0.5, max_reconnect_delay: float = 60.0,
+                 protocol: int = mqtt.MQTTv311, topic_aliases: int = 0, keepalive: int = 60,
+                 ack_timeout: float = 30.0):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.protocol = protocol
+        self.topic_aliases = topic_aliases
+        # Reconnects start fast and back off with jitter while the broker stays away
+        self.reconnect_backoff = JitteredBackoff(reconnect_delay, max_reconnect_delay)
+        self.keepalive = keepalive
+        # A session whose oldest in-flight publish goes unacknowledged this long is dropped and re-established
+        self.ack_timeout = ack_timeout
+        self._last_progress = time.monotonic()
+        self.connected = asyncio.Event()
+        self.dropped = 0
+        self.connections = 0  # Sessions established so far
+        self._queue: Deque[OutgoingMessage] = deque(maxlen=queue_size)
+        self._wake = asyncio.Event()
+        self._inflight: Set[asyncio.Future] = set()
+        # Publishes that failed with the session, put back in order once it is torn down
+        self._unsent: List[OutgoingMessage] = []
+        self._client: Optional[LoopClient] = None
+        self._task: Optional[asyncio.Task] = None
+        self._subscriptions: Dict[str, Callable[[bytes], None]] = {}
+        self._failed = False
+        self._stopping = False
+
+    @property
+    def backlog(self) -> int:
+        return len(self._queue)
+
+    async def wait_writable(self):
+        """For producers that prefer waiting over drops: block while the queue is over half full"""
+        while self.connected.is_set() and len(self._queue) >= self._queue.maxlen // 2:
+            await asyncio.sleep(0.01)
+
+    def publish(self, topic: str, payload: Union[str, bytes], retain: bool = True,
+                on_sent: Optional[Callable[[], None]] = None) -> bool:
+        """Queue a message; returns False if an older message had to be dropped"""
+        accepted = len(self._queue) < self._queue.maxlen
+        if not accepted:
+            self.dropped += 1
+            metrics.MQTT_DROPPED.inc()
+            logger.warning(f"MQTT publish queue full, dropping oldest message ({self.dropped} dropped)")
+        self._queue.append(OutgoingMessage(topic, payload, retain, time.monotonic(), on_sent))
+        self._wake.set()
+        return accepted
+
+    async def deliver(self, topic: str, payload: Union[str, bytes], retain: bool = False) -> bool:
+        """Publish directly, bypassing the queue, and report whether it was delivered"""
+        client = self._client
+        if client is None:
+            return False
+        try:
+            await client.publish(topic, payload, qos=self.qos, retain=retain)
+            metrics.MQTT_ACKS.inc()
+            return True
+        except MqttError as e:
+            metrics.MQTT_FAILURES.inc()
+            logger.warning(f"Failed to deliver {topic}: {e}")
+            self._fail()
+            return False
+
+    def subscribe(self, topic: str, callback: Callable[[bytes], None]):
+        """Call callback with the payload of every message on topic (wildcards allowed), across reconnects"""
+        self._subscriptions[topic] = callback
+
+    def start(self) -> asyncio.Task:
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def run(self):
+        """Connect, drain the queue and reconnect after failures until stop()"""
+        while not self._stopping:
+            client: Optional[LoopClient] = None
+            watch: Optional[asyncio.Task] = None
+            try:
+                client = LoopClient(
+                    self.host,
+                    self.port,
+                    username=self.username,
+                    password=self.password,
+                    max_inflight=self.max_inflight,
+                    keepalive=self.keepalive,
+                    on_message=self._dispatch,
+                    protocol=self.protocol,
+                    topic_aliases=self.topic_aliases,
+                )
+                await client.connect()
+                client.lost.add_done_callback(lambda _: self._fail())
+                self._client = client
+                self._failed = False
+                self._last_progress = time.monotonic()
+                self.connections += 1
+                if self.connections > 1:
+                    metrics.MQTT_RECONNECTS.inc()
+                self.reconnect_backoff.reset()
+                self.connected.set()
+                logger.info("Connected to MQTT broker")
+                for topic in self._subscriptions:
+                    client.subscribe(topic)
+                watch = asyncio.create_task(self._watch_acks())
+                await self._drain(client)
+            except (MqttError, OSError, asyncio.TimeoutError) as e:
+                logger.error(f"MQTT connection error: {e!r}")
+            finally:
+                if watch:
+                    watch.cancel()
+                self.connected.clear()
+                self._client = None
+                if client:
+                    await client.disconnect()
+                await self._settle()
+            if not self._stopping:
+                delay = self.reconnect_backoff.next()
+                logger.info(f"Reconnecting to MQTT broker in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    async def _drain(self, client: LoopClient):
+        while not self._stopping:
+            if self._failed:
+                raise MqttError("Broker session failed")
+            if not self._queue or len(self._inflight) >= self.max_inflight:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            while self._queue and len(self._inflight) < self.max_inflight and not self._failed:
+                self._send(client, self._queue.popleft())
+
+    def _dispatch(self, topic: str, payload: bytes):
+        callback = self._subscriptions.get(topic)
+        if callback is None:
+            # Wildcard subscriptions (+ and #)
+            callback = next((cb for topic_filter, cb in self._subscriptions.items()
+                             if mqtt.topic_matches_sub(topic_filter, topic)), None)
+        if callback:
+            try:
+                callback(payload)
+            except Exception as e:
+                logger.error(f"Error handling message on {topic}: {e}")
+
+    async def _watch_acks(self):
+        """Fail the session when publishes stay unacknowledged, e.g. on a half-open connection"""
+        while True:
+            await asyncio.sleep(1)
+            if self._inflight and time.monotonic() - self._last_progress > self.ack_timeout:
+                logger.warning(f"No MQTT acknowledgement for {self.ack_timeout:.0f}s, re-establishing the session")
+                self._fail()
+                return
+
+    def _fail(self):
+        self._failed = True
+        self._wake.set()
+
+    def _send(self, client: LoopClient, message: OutgoingMessage):
+        try:
+            future = client.publish_nowait(message.topic, message.payload, qos=self.qos, retain=message.retain)
+        except MqttError as e:
+            self._failed_send(message, e)
+            return
+        if not self._inflight:
+            # Waiting for acknowledgements starts now, not at the last one before an idle spell
+            self._last_progress = time.monotonic()
+        self._inflight.add(future)
+        future.add_done_callback(lambda done: self._sent(message, done))
+
+    def _sent(self, message: OutgoingMessage, future: asyncio.Future):
+        self._inflight.discard(future)
+        self._wake.set()
+        error = MqttError("Publish cancelled") if future.cancelled() else future.exception()
+        if error is not None:
+            self._failed_send(message, error)
+            return
+        metrics.MQTT_ACKS.inc()
+        self._last_progress = now = time.monotonic()
+        metrics.MQTT_PUBLISH_SECONDS.observe(now - message.queued_at)
+        logger.debug("Published %s", message.topic)
+        if message.on_sent:
+            message.on_sent()
+
+    def _failed_send(self, message: OutgoingMessage, error: BaseException):
+        metrics.MQTT_FAILURES.inc()
+        logger.warning(f"Failed to publish {message.topic}: {error}")
+        self._unsent.append(message)
+        self._fail()
+
+    async def _settle(self):
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        if not self._unsent:
+            return
+        # In-flight publishes fail in no particular order; resending them oldest first keeps an
+        # older value from overwriting a newer retained one. Newer data crowds out the oldest.
+        unsent = sorted(self._unsent, key=lambda message: message.queued_at)
+        self._unsent.clear()
+        room = self._queue.maxlen - len(self._queue)
+        if len(unsent) > room:
+            self.dropped += len(unsent) - room
+            metrics.MQTT_DROPPED.inc(len(unsent) - room)
+            unsent = unsent[len(unsent) - room:]
+        self._queue.extendleft(reversed(unsent))
+
+    async def flush(self, timeout: float = 5.0):
+        """Wait until the queue is drained and all in-flight publishes completed"""
+        async def _wait():
+            while self._queue or self._inflight:
+                await asyncio.sleep(0.05)
+        try:
+            await asyncio.wait_for(_wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Timed out flushing MQTT queue ({len(self._queue)} messages left)")
+
+    async def stop(self, timeout: float = 5.0):
+        if self.connected.is_set():
+            await self.flush(timeout)
+        self._stopping = True
+        self._wake.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+            self._task = None
@@ -2,12 +2,24 @@
 """
 MQTT Test Client for Victron MPPT Data
 Tests MQTT authentication and subscribes to MPPT topics
+
+With --load-test it instead drives N simulated publishers through the real
+publish path and reports end-to-end latency, throughput, gaps and duplicates:
+
+    python mqtt_test_client.py --load-test --local-broker --publishers 4 --devices 50
+    python mqtt_test_client.py --load-test --publishers 10 --devices 100 --rate 2 --duration 120
 """
+import argparse
+import asyncio
 import os
 import json
 import logging
+import tempfile
+import threading
 import time
+from collections import defaultdict
 from datetime import datetime
+from typing import Any, Dict, List, Tuple
 import paho.mqtt.client as mqtt
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -219,8 +231,320 @@ class MQTTTestClient:
             self.client.disconnect()
             logger.info("MQTT client disconnected")
 
+LOAD_TEST_TOPIC = "victron_loadtest"
+# Distinct advertisements per simulated device, more than the registry's repeat window
+ADVERTISEMENT_POOL = 16
+
+
+class LoadTest:
+    """End-to-end load test of the publish path.
+
+    Starts `publishers` VictronMPPTReader instances, each with its own broker
+    connection and `devices` simulated SolarChargers sending `rate` readings/s,
+    and feeds their advertisements through process_advertisement as the
+    scanner would. A separate subscriber thread receives every /all message;
+    latency is measured from the reading's timestamp to its receipt, and each
+    device's sequence of readings is checked for gaps, duplicates and
+    reordering.
+    """
+
+    def __init__(self, publishers: int = 1, devices: int = 10, rate: float = 1.0, duration: float = 30.0,
+                 local_broker: bool = False, settle: float = 5.0):
+        self.publishers = publishers
+        self.devices = devices
+        self.rate = rate
+        self.duration = duration
+        self.local_broker = local_broker
+        self.settle = settle
+        self.mqtt_host = os.getenv("MQTT_HOST", "localhost")
+        self.mqtt_port = int(os.getenv("MQTT_PORT", "1883"))
+        self.mqtt_user = os.getenv('MQTT_USER')
+        self.mqtt_password = os.getenv('MQTT_PASSWORD')
+        
+        # Topic prefix -> ISO timestamp -> (sequence number, reading timestamp)
+        self.expected: Dict[str, Dict[str, Tuple[int, float]]] = defaultdict(dict)
+        # (receipt time, topic, payload) in arrival order, appended from the subscriber thread
+        self.received: List[Tuple[float, str, bytes]] = []
+        self.subscribed = threading.Event()
+        self.generator_lag: List[float] = []
+    
+    def on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc == 0:
+            client.subscribe(f"{LOAD_TEST_TOPIC}/+/+/all")
+        else:
+            logger.error(f"✗ Load test subscriber connection failed (code: {rc})")
+    
+    def on_subscribe(self, client, userdata, mid, granted_qos, properties=None):
+        self.subscribed.set()
+    
+    def on_message(self, client, userdata, msg):
+        # Retained copies are from earlier runs; everything else is analysed after the run
+        if not msg.retain:
+            self.received.append((time.time(), msg.topic, msg.payload))
+    
+    async def run(self) -> Dict[str, Any]:
+        from local_broker import LocalBroker
+        
+        broker = None
+        if self.local_broker:
+            broker = LocalBroker()
+            self.mqtt_host, self.mqtt_port = '127.0.0.1', await broker.start()
+        
+        subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=f"victron_loadtest_{int(time.time())}")
+        if self.mqtt_user:
+            subscriber.username_pw_set(self.mqtt_user, self.mqtt_password)
+        subscriber.on_connect = self.on_connect
+        subscriber.on_subscribe = self.on_subscribe
+        subscriber.on_message = self.on_message
+        subscriber.connect(self.mqtt_host, self.mqtt_port, 60)
+        subscriber.loop_start()
+        
+        readers = []
+        configs = []
+        try:
+            if not await asyncio.to_thread(self.subscribed.wait, 10):
+                raise RuntimeError(f"Subscriber could not subscribe on {self.mqtt_host}:{self.mqtt_port}")
+            readers, configs = self.create_readers()
+            for reader in readers:
+                reader.setup_mqtt()
+            await asyncio.wait_for(asyncio.gather(*(reader.publisher.connected.wait() for reader in readers)), 10)
+            
+            logger.info(f"Load test: {self.publishers} publishers x {self.devices} devices at {self.rate} readings/s "
+                        f"for {self.duration}s against {self.mqtt_host}:{self.mqtt_port}")
+            started = time.monotonic()
+            pools = self.advertisement_pools(readers)
+            await asyncio.gather(*(self.drive(reader, pool, started) for reader, pool in zip(readers, pools)))
+            await asyncio.gather(*(reader.publisher.flush(30) for reader in readers))
+            elapsed = time.monotonic() - started
+            
+            # Give the subscriber time to receive what is still on its way
+            total = sum(len(readings) for readings in self.expected.values())
+            deadline = time.monotonic() + self.settle
+            while len(self.received) < total and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+        finally:
+            for reader in readers:
+                if reader.publisher:
+                    await reader.publisher.stop()
+            subscriber.loop_stop()
+            subscriber.disconnect()
+            if broker:
+                await broker.stop()
+            for path in configs:
+                os.unlink(path)
+        
+        report = self.analyze(elapsed)
+        report['dropped'] = sum(reader.publisher.dropped for reader in readers)
+        if broker:
+            report['broker'] = {
+                'messages_received': broker.messages_received,
+                'messages_per_s': round(broker.messages_received / elapsed, 1),
+                'bytes_received': broker.bytes_received,
+            }
+        return report
+    
+    def create_readers(self) -> Tuple[list, List[str]]:
+        """One reader per publisher, each with its own device file and broker connection"""
+        import main
+        from benchmark import synthetic_devices
+        
+        os.environ.update({
+            'MQTT_HOST': self.mqtt_host,
+            'MQTT_PORT': str(self.mqtt_port),
+            'MQTT_USER': self.mqtt_user or 'loadtest',
+            'MQTT_PASSWORD': self.mqtt_password or 'loadtest',
+            'OFFLINE_QUEUE_DIR': '',
+            # Every reading must reach /all for the sequence checks to hold
+            'CHANGE_DETECTION': '0',
+            'ADAPTIVE_PUBLISH': '0',
+            # Keep simulated devices out of a real Home Assistant
+            'HA_DISCOVERY': '0',
+        })
+        for name in ('CAPTURE_FILE', 'REPLAY_FILE', 'TIMESERIES_DIR', 'AGGREGATION_WINDOW'):
+            os.environ.pop(name, None)
+        
+        devices = synthetic_devices(self.publishers * self.devices)
+        readers, configs = [], []
+        for publisher in range(self.publishers):
+            with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+                json.dump([{'address': address, 'key': key.hex(), 'name': f"Load {publisher}-{n}",
+                            'topic': f"{LOAD_TEST_TOPIC}/p{publisher}/d{n}"}
+                           for n, (address, key) in enumerate(devices[publisher * self.devices:(publisher + 1) * self.devices])], f)
+            configs.append(f.name)
+            os.environ['DEVICES_CONFIG'] = f.name
+            readers.append(main.VictronMPPTReader())
+        return readers, configs
+    
+    def advertisement_pools(self, readers: list) -> List[List[Tuple[str, str, List[bytes]]]]:
+        """Per reader: (address, topic prefix, encrypted advertisements to cycle through) per device"""
+        from benchmark import synthetic_advertisements
+        
+        pools = []
+        for reader in readers:
+            devices = [(config.address, bytes.fromhex(config.key)) for config in reader.registry]
+            raws: Dict[str, List[bytes]] = defaultdict(list)
+            for _, address, raw in synthetic_advertisements(devices, len(devices) * ADVERTISEMENT_POOL):
+                raws[address].append(raw)
+            pools.append([(address, reader.registry.lookup(address).topic_prefix, raws[address])
+                          for address, _ in devices])
+        return pools
+    
+    async def drive(self, reader, pool: List[Tuple[str, str, List[bytes]]], started: float):
+        """Offer readings round-robin at the configured rate, catching up in bursts when behind"""
+        from readings import iso_timestamp
+        
+        total_rate = self.rate * len(pool)
+        last_ms: Dict[str, int] = {}
+        sent = 0
+        while True:
+            elapsed = time.monotonic() - started
+            if elapsed >= self.duration:
+                break
+            due = int(elapsed * total_rate) + 1
+            while sent < due:
+                self.generator_lag.append(elapsed - sent / total_rate)
+                address, prefix, raws = pool[sent % len(pool)]
+                sequence = sent // len(pool)
+                # Timestamps identify readings, so keep them unique per device at millisecond resolution
+                received_at = max(time.time(), (last_ms.get(address, 0) + 1) / 1000)
+                timestamp_ms = last_ms[address] = int(received_at * 1000)
+                self.expected[prefix][iso_timestamp(timestamp_ms)] = (sequence, received_at)
+                advertisement = reader.match_advertisement(address, raws[sequence % len(raws)], received_at)
+                if advertisement:
+                    await reader.process_advertisement(advertisement)
+                sent += 1
+            await asyncio.sleep(max(0.0, sent / total_rate - (time.monotonic() - started)))
+    
+    def analyze(self, elapsed: float) -> Dict[str, Any]:
+        from benchmark import percentiles
+        from compact_encoding import unpackb
+        from readings import iso_timestamp
+        
+        latencies = []
+        seen: Dict[str, Dict[int, int]] = defaultdict(dict)
+        out_of_order: Dict[str, int] = defaultdict(int)
+        last_sequence: Dict[str, int] = {}
+        unexpected = 0
+        for received_at, topic, payload in self.received:
+            prefix = topic[:-len('/all')]
+            try:
+                if payload[:1] == b'{':
+                    key = json.loads(payload)['timestamp']
+                else:
+                    key = iso_timestamp(unpackb(payload)[1])
+            except (ValueError, KeyError, IndexError, TypeError):
+                unexpected += 1
+                continue
+            match = self.expected.get(prefix, {}).get(key)
+            if match is None:
+                unexpected += 1
+                continue
+            sequence, timestamp = match
+            counts = seen[prefix]
+            counts[sequence] = counts.get(sequence, 0) + 1
+            if counts[sequence] > 1:
+                continue
+            latencies.append(received_at - timestamp)
+            if sequence < last_sequence.get(prefix, -1):
+                out_of_order[prefix] += 1
+            else:
+                last_sequence[prefix] = sequence
+        
+        topics = {}
+        for prefix, readings in self.expected.items():
+            counts = seen.get(prefix, {})
+            sequences = sorted(sequence for sequence, _ in readings.values())
+            missing = [sequence for sequence in sequences if sequence not in counts]
+            # A gap is a run of consecutive missing readings
+            gaps = sum(1 for index, sequence in enumerate(missing) if index == 0 or missing[index - 1] != sequence - 1)
+            topics[f"{prefix}/all"] = {
+                'sent': len(sequences),
+                'received': len(counts),
+                'missing': len(missing),
+                'gaps': gaps,
+                'duplicates': sum(count - 1 for count in counts.values()),
+                'out_of_order': out_of_order.get(prefix, 0),
+            }
+        
+        sent = sum(topic['sent'] for topic in topics.values())
+        received = sum(topic['received'] for topic in topics.values())
+        latency = {metric.replace('_us', '_ms'): round(value / 1000, 3) if metric.endswith('_us') else value
+                   for metric, value in percentiles(latencies).items()}
+        if latencies:
+            latency['max_ms'] = round(max(latencies) * 1000, 3)
+        return {
+            'config': {
+                'publishers': self.publishers,
+                'devices_per_publisher': self.devices,
+                'readings_per_s_per_device': self.rate,
+                'duration_s': self.duration,
+                'broker': 'local' if self.local_broker else f"{self.mqtt_host}:{self.mqtt_port}",
+                'protocol': os.getenv('MQTT_PROTOCOL', '3.1.1'),
+                'qos': int(os.getenv('MQTT_QOS', '1')),
+                'all_encoding': os.getenv('ALL_ENCODING', 'json'),
+            },
+            'elapsed_s': round(elapsed, 2),
+            'sent': sent,
+            'received': received,
+            'offered_readings_per_s': round(sent / elapsed, 1),
+            'received_readings_per_s': round(received / elapsed, 1),
+            'latency': latency,
+            'max_generator_lag_ms': round(max(self.generator_lag, default=0.0) * 1000, 1),
+            'missing': sum(topic['missing'] for topic in topics.values()),
+            'gaps': sum(topic['gaps'] for topic in topics.values()),
+            'duplicates': sum(topic['duplicates'] for topic in topics.values()),
+            'out_of_order': sum(topic['out_of_order'] for topic in topics.values()),
+            'unexpected': unexpected,
+            'topics': topics,
+        }
+
+
+def print_load_report(report: Dict[str, Any]):
+    config = report['config']
+    latency = report['latency']
+    logger.info("="*60)
+    logger.info(f"LOAD TEST: {config['publishers']} publishers x {config['devices_per_publisher']} devices "
+                f"at {config['readings_per_s_per_device']} readings/s ({config['broker']}, MQTT {config['protocol']})")
+    logger.info("="*60)
+    logger.info(f"  Sent: {report['sent']} readings ({report['offered_readings_per_s']:.0f}/s), "
+                f"received: {report['received']} ({report['received_readings_per_s']:.0f}/s)")
+    if latency:
+        logger.info(f"  Latency ms: p50 {latency['p50_ms']}  p95 {latency['p95_ms']}  "
+                    f"p99 {latency['p99_ms']}  max {latency['max_ms']}")
+    logger.info(f"  Missing: {report['missing']} in {report['gaps']} gaps, duplicates: {report['duplicates']}, "
+                f"out of order: {report['out_of_order']}, dropped by publishers: {report['dropped']}")
+    if 'broker' in report:
+        logger.info(f"  Broker: {report['broker']['messages_per_s']:.0f} msg/s")
+    if report['max_generator_lag_ms'] > 1000:
+        logger.warning(f"  Publishers fell {report['max_generator_lag_ms']:.0f} ms behind the offered rate; "
+                       f"this host cannot generate the requested load")
+
+
+def run_load_test(args: argparse.Namespace) -> int:
+    load_test = LoadTest(args.publishers, args.devices, args.rate, args.duration, args.local_broker, args.settle)
+    report = asyncio.run(load_test.run())
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_load_report(report)
+    logger.info(f"Report written to {args.report}")
+    return 1 if report['missing'] or report['duplicates'] else 0
+
+
 def main():
     """Main test function"""
+    parser = argparse.ArgumentParser(description="Victron MQTT test client and load tester")
+    parser.add_argument('--load-test', action='store_true', help="Run the end-to-end load test instead of monitoring")
+    parser.add_argument('--publishers', type=int, default=1, help="Simulated publishers, one broker connection each (default: 1)")
+    parser.add_argument('--devices', type=int, default=10, help="Simulated devices per publisher (default: 10)")
+    parser.add_argument('--rate', type=float, default=1.0, help="Readings per second per device (default: 1)")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds of load (default: 30)")
+    parser.add_argument('--settle', type=float, default=5.0, help="Seconds to wait for late messages (default: 5)")
+    parser.add_argument('--local-broker', action='store_true', help="Use the in-process local_broker stand-in")
+    parser.add_argument('--report', default='load_test_report.json', help="JSON report path (default: load_test_report.json)")
+    args = parser.parse_args()
+    if args.load_test:
+        return run_load_test(args)
+    
     print(f"Victron MQTT Test Client - {datetime.now()}")
     print("="*60)
     
@@ -0,0 +1,192 @@
+"""
+Append-only, segment-based on-disk queue for readings that could not be published
+"""
+import logging
+import mmap
+import os
+import struct
+import zlib
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Record header: payload length, crc32 of payload. A zero length marks the end of a segment.
+HEADER = struct.Struct('<II')
+CURSOR_FILE = 'cursor'
+
+
+class Segment:
+    """One preallocated, memory-mapped segment file"""
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.seq = int(os.path.basename(path)[4:-4])
+        existed = os.path.exists(path)
+        self._file = open(path, 'r+b' if existed else 'w+b')
+        if os.fstat(self._file.fileno()).st_size < size:
+            self._file.truncate(size)
+        self.size = os.fstat(self._file.fileno()).st_size
+        self._map = mmap.mmap(self._file.fileno(), self.size)
+        self.end = self._scan_end() if existed else 0
+
+    def _scan_end(self) -> int:
+        end = 0
+        for offset, payload in self.records(0):
+            end = offset + HEADER.size + len(payload)
+        return end
+
+    def records(self, offset: int):
+        """Yield (offset, payload) of every intact record from offset on"""
+        while offset + HEADER.size <= self.size:
+            length, crc = HEADER.unpack_from(self._map, offset)
+            start = offset + HEADER.size
+            if length == 0 or start + length > self.size:
+                return
+            payload = self._map[start:start + length]
+            if zlib.crc32(payload) != crc:
+                logger.warning(f"Corrupt record in {self.path} at {offset}, ignoring rest of segment")
+                return
+            yield offset, payload
+            offset = start + length
+
+    def fits(self, length: int) -> bool:
+        # Leave room for the zero-length terminator unless the segment ends exactly
+        return self.end + HEADER.size + length <= self.size
+
+    def append(self, payload: bytes):
+        HEADER.pack_into(self._map, self.end, len(payload), zlib.crc32(payload))
+        start = self.end + HEADER.size
+        self._map[start:start + len(payload)] = payload
+        self.end = start + len(payload)
+        if self.end + HEADER.size <= self.size:
+            HEADER.pack_into(self._map, self.end, 0, 0)
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        self._map.flush()
+        self._map.close()
+        self._file.close()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+
+class OfflineQueue:
+    """Bounded FIFO of opaque records persisted across restarts.
+
+    Records are appended to the newest segment and read from a persisted
+    cursor. Fully read segments are deleted; when the queue exceeds
+    max_bytes the oldest segment is evicted whether it was read or not.
+    """
+
+    def __init__(self, directory: str, segment_size: int = 1 << 20, max_bytes: int = 64 << 20):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max(2, max_bytes // segment_size)
+        self.evicted = 0
+        os.makedirs(directory, exist_ok=True)
+
+        paths = sorted(p for p in os.listdir(directory) if p.startswith('seg-') and p.endswith('.log'))
+        self._segments: List[Segment] = [Segment(os.path.join(directory, p), segment_size) for p in paths]
+        if not self._segments:
+            self._segments.append(self._new_segment(0))
+        self._cursor = self._load_cursor()
+        self._pending = sum(1 for _ in self._iter_pending())
+        if self._pending:
+            logger.info(f"Offline queue holds {self._pending} unpublished records")
+
+    def __len__(self) -> int:
+        return self._pending
+
+    def _new_segment(self, seq: int) -> Segment:
+        return Segment(os.path.join(self.directory, f"seg-{seq:012d}.log"), self.segment_size)
+
+    def _load_cursor(self) -> Tuple[int, int]:
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE)) as f:
+                seq, offset = (int(part) for part in f.read().split())
+        except (OSError, ValueError):
+            return self._segments[0].seq, 0
+        if seq < self._segments[0].seq:
+            return self._segments[0].seq, 0
+        return seq, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + '.tmp', 'w') as f:
+            f.write(f"{self._cursor[0]} {self._cursor[1]}")
+        os.replace(path + '.tmp', path)
+
+    def _iter_pending(self, limit: Optional[int] = None):
+        """Yield (segment, offset, payload) from the read cursor on"""
+        count = 0
+        seq, offset = self._cursor
+        for segment in self._segments:
+            if segment.seq < seq:
+                continue
+            for record_offset, payload in segment.records(offset if segment.seq == seq else 0):
+                yield segment, record_offset, payload
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+    def append(self, payload: bytes) -> bool:
+        if HEADER.size + len(payload) > self.segment_size:
+            logger.error(f"Record of {len(payload)} bytes exceeds segment size, not queued")
+            return False
+        tail = self._segments[-1]
+        if not tail.fits(len(payload)):
+            tail.flush()
+            tail = self._new_segment(tail.seq + 1)
+            self._segments.append(tail)
+            self._evict()
+        tail.append(payload)
+        self._pending += 1
+        return True
+
+    def _evict(self):
+        while len(self._segments) > self.max_segments:
+            oldest = self._segments.pop(0)
+            if oldest.seq >= self._cursor[0]:
+                lost = sum(1 for _ in oldest.records(self._cursor[1] if oldest.seq == self._cursor[0] else 0))
+                self._pending -= lost
+                self.evicted += lost
+                logger.warning(f"Offline queue full, evicted {lost} oldest records")
+                self._cursor = (self._segments[0].seq, 0)
+                self._save_cursor()
+            oldest.delete()
+
+    def peek(self, max_records: int) -> List[bytes]:
+        """Up to max_records oldest unread records, without consuming them"""
+        return [payload for _, _, payload in self._iter_pending(max_records)]
+
+    def commit(self, count: int):
+        """Consume the first count records returned by peek()"""
+        if count <= 0:
+            return
+        last = None
+        for last in self._iter_pending(count):
+            pass
+        if last is None:
+            return
+        segment, offset, payload = last
+        self._cursor = (segment.seq, offset + HEADER.size + len(payload))
+        self._pending = max(0, self._pending - count)
+        # Drop segments that have been read completely, keeping the one being appended to
+        while len(self._segments) > 1 and self._segments[0].seq < self._cursor[0]:
+            self._segments.pop(0).delete()
+        if self._segments[0].seq == self._cursor[0] and self._cursor[1] >= self._segments[0].end \
+                and len(self._segments) > 1:
+            self._segments.pop(0).delete()
+            self._cursor = (self._segments[0].seq, 0)
+        self._save_cursor()
+
+    def flush(self):
+        self._segments[-1].flush()
+
+    def close(self):
+        for segment in self._segments:
+            segment.close()
@@ -0,0 +1,110 @@
+"""
+Adaptive per-device publish scheduling: fast on events and big swings, backing off while values are flat
+"""
+import logging
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+from change_filter import Deadband
+
+logger = logging.getLogger(__name__)
+
+# State-like fields whose transitions are always published immediately
+DEFAULT_EVENT_FIELDS = ('charge_state', 'device_state', 'charger_error', 'error_code',
+                        'off_reason', 'alarm', 'load_state', 'warning_reason')
+
+
+class SchedulePolicy(NamedTuple):
+    min_interval: float = 2.0  # Never publish a device faster than this, except for events
+    max_interval: float = 300.0  # Publish at least this often, even when nothing changes
+    jump: float = 0.2  # Relative change (or a rise from zero) that skips the back-off
+    noise: float = 0.01  # Relative change below which a value counts as flat
+    event_fields: Tuple[str, ...] = DEFAULT_EVENT_FIELDS
+
+    def updated(self, overrides: Dict[str, Any]) -> "SchedulePolicy":
+        """Copy with the keys of a DEVICES_CONFIG "schedule" object applied"""
+        unknown = set(overrides) - set(self._fields)
+        if unknown:
+            raise ValueError(f"Unknown schedule settings: {', '.join(sorted(unknown))}")
+        values = {key: float(value) for key, value in overrides.items() if key != 'event_fields'}
+        if 'event_fields' in overrides:
+            values['event_fields'] = tuple(overrides['event_fields'])
+        return self._replace(**values)
+
+
+class _DeviceSchedule:
+    __slots__ = ('policy', 'interval', 'last_published', 'last_values')
+
+    def __init__(self, policy: SchedulePolicy):
+        self.policy = policy
+        self.interval = policy.min_interval
+        self.last_published: Optional[float] = None
+        self.last_values: Dict[str, Any] = {}
+
+
+class AdaptiveScheduler:
+    """Decides per reading whether a device's values go out now.
+
+    Each device has an interval between min_interval and max_interval.
+    Event-field transitions publish at once and a jump publishes after
+    min_interval; both reset the interval. Otherwise a reading is published
+    once the interval has passed, and the interval halves if values moved
+    beyond their deadband (or the noise floor) and doubles if they were flat.
+    """
+
+    def __init__(self, default: SchedulePolicy, deadbands: Optional[Dict[str, Deadband]] = None):
+        self.default = default
+        self.deadbands = deadbands or {}
+        self._policies: Dict[str, SchedulePolicy] = {}
+        self._devices: Dict[str, _DeviceSchedule] = {}
+
+    def set_policy(self, key: str, policy: SchedulePolicy):
+        self._policies[key] = policy
+        self._devices.pop(key, None)
+
+    def interval(self, key: str) -> Optional[float]:
+        schedule = self._devices.get(key)
+        return schedule.interval if schedule else None
+
+    def should_publish(self, key: str, data: Dict[str, Any], now: float) -> bool:
+        """now is a monotonic time (capture time during a replay); returns True if this reading should be published"""
+        schedule = self._devices.get(key)
+        if schedule is None:
+            schedule = self._devices[key] = _DeviceSchedule(self._policies.get(key, self.default))
+        policy = schedule.policy
+        if schedule.last_published is None:
+            return self._publish(schedule, data, now, policy.min_interval)
+
+        elapsed = now - schedule.last_published
+        last = schedule.last_values
+        if any(data.get(name) != last.get(name) for name in policy.event_fields if name in data):
+            logger.debug("Publishing %s on state change", key)
+            return self._publish(schedule, data, now, policy.min_interval)
+        if elapsed < policy.min_interval:
+            return False
+
+        noise = Deadband(relative=policy.noise)
+        moved = jumped = False
+        for name, value in data.items():
+            previous = last.get(name)
+            if (not isinstance(value, (int, float)) or isinstance(value, bool)
+                    or not isinstance(previous, (int, float)) or isinstance(previous, bool)):
+                continue
+            delta = abs(value - previous)
+            if delta > policy.jump * abs(previous):
+                jumped = True
+                break
+            if self.deadbands.get(name, noise).exceeded(previous, value):
+                moved = True
+
+        if jumped:
+            return self._publish(schedule, data, now, policy.min_interval)
+        if elapsed >= schedule.interval:
+            interval = schedule.interval / 2 if moved else schedule.interval * 2
+            return self._publish(schedule, data, now, min(max(interval, policy.min_interval), policy.max_interval))
+        return False
+
+    def _publish(self, schedule: _DeviceSchedule, data: Dict[str, Any], now: float, interval: float) -> bool:
+        schedule.last_published = now
+        schedule.last_values = data
+        schedule.interval = interval
+        return True
@@ -0,0 +1,112 @@
+"""
+Compact reading records: one fixed field order per parsed-data class and a slotted record per reading
+"""
+import json
+import time
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# Value of a field whose getter failed; the field is left out as if absent
+MISSING = object()
+
+
+def iso_timestamp(timestamp_ms: int) -> str:
+    """Local ISO 8601 text of an epoch-millisecond timestamp, as published on {topic}/timestamp"""
+    return datetime.fromtimestamp(timestamp_ms / 1000).isoformat()
+
+
+class ReadingLayout:
+    """Field names, in order, shared by every reading of one parsed-data class"""
+
+    __slots__ = ('name', 'fields', 'index', '_extensions')
+
+    def __init__(self, name: str, fields: Tuple[str, ...]):
+        self.name = name
+        self.fields = fields
+        self.index = {field: position for position, field in enumerate(fields)}
+        self._extensions: Dict[Tuple[str, ...], ReadingLayout] = {}
+
+    def extended(self, names: Tuple[str, ...]) -> "ReadingLayout":
+        """This layout followed by names, built once per distinct tuple of names"""
+        layout = self._extensions.get(names)
+        if layout is None:
+            clashes = [name for name in names if name in self.index]
+            if clashes:
+                raise ValueError(f"{self.name} already has fields {', '.join(clashes)}")
+            layout = self._extensions[names] = ReadingLayout(self.name, self.fields + names)
+        return layout
+
+
+class Reading(Mapping):
+    """One decoded reading: a tuple of values in layout order plus its timestamps.
+
+    It reads like the dict it replaces ('timestamp' as ISO text first, then the
+    fields), so filters, discovery and the stores need no changes. Serialized
+    forms are built on first use and cached on the record.
+    """
+
+    __slots__ = ('layout', 'values', 'timestamp_ms', 'monotonic_ns', '_cache')
+
+    def __init__(self, layout: ReadingLayout, values: Tuple[Any, ...], timestamp_ms: int,
+                 monotonic_ns: Optional[int] = None):
+        self.layout = layout
+        self.values = values
+        self.timestamp_ms = timestamp_ms  # Epoch milliseconds of reception
+        self.monotonic_ns = time.monotonic_ns() if monotonic_ns is None else monotonic_ns
+        self._cache: Optional[Dict[str, Any]] = None
+
+    @property
+    def timestamp(self) -> str:
+        return self.cached('timestamp', lambda: iso_timestamp(self.timestamp_ms))
+
+    def __getitem__(self, key: str) -> Any:
+        if key == 'timestamp':
+            return self.timestamp
+        value = self.values[self.layout.index[key]]
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        yield 'timestamp'
+        for field, value in zip(self.layout.fields, self.values):
+            if value is not MISSING:
+                yield field
+
+    def __len__(self) -> int:
+        return 1 + sum(value is not MISSING for value in self.values)
+
+    def items(self) -> List[Tuple[str, Any]]:
+        items = [('timestamp', self.timestamp)]
+        if MISSING in self.values:
+            items.extend((field, value) for field, value in zip(self.layout.fields, self.values) if value is not MISSING)
+        else:
+            items.extend(zip(self.layout.fields, self.values))
+        return items
+
+    def with_fields(self, fields: Dict[str, Any]) -> "Reading":
+        """A copy of this reading with fields appended after the existing ones"""
+        if not fields:
+            return self
+        return Reading(self.layout.extended(tuple(fields)), self.values + tuple(fields.values()),
+                       self.timestamp_ms, self.monotonic_ns)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.items())
+
+    def to_json(self) -> str:
+        return self.cached('json', lambda: json.dumps(self.to_dict()))
+
+    def cached(self, key: str, build: Callable[[], Any]) -> Any:
+        """Value of build(), computed once per record and key (e.g. one serialization format)"""
+        cache = self._cache
+        if cache is None:
+            cache = self._cache = {}
+        value = cache.get(key)
+        if value is None:
+            value = cache[key] = build()
+        return value
+
+    def __repr__(self) -> str:
+        return f"Reading({self.layout.name}, {self.to_dict()!r})"
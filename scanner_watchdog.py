@@ -0,0 +1,97 @@
+"""
+Restarts a stalled BLE scanner in-process, with jittered exponential backoff between attempts
+"""
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, Iterable, Optional
+
+from backoff import JitteredBackoff
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest gap in each device's average advertisement interval
+INTERVAL_SMOOTHING = 0.1
+
+
+class ScannerWatchdog:
+    """Tracks when each device was last heard and restarts the scanner once all of them are overdue.
+
+    A device is overdue after `factor` times its average advertisement
+    interval (at least `min_silence` seconds) without a frame. A single quiet
+    device may just be out of range, so only when every device is overdue is
+    the scanner taken to be stuck (stalled adapter, restarted BlueZ) and
+    restarted. The first restart happens at once; while restarts bring
+    nothing back, the next ones are spaced by jittered exponential backoff.
+    """
+
+    def __init__(self, devices: Iterable[str], restart: Callable[[], Awaitable[bool]], factor: float = 5.0,
+                 min_silence: float = 3.0, max_delay: float = 60.0, default_interval: float = 1.0,
+                 check_interval: float = 0.5):
+        self.restart = restart
+        self.factor = factor
+        self.min_silence = min_silence
+        self.default_interval = default_interval
+        self.check_interval = check_interval
+        self.backoff = JitteredBackoff(1.0, max_delay)
+        self.restarts = 0
+        # Silence is counted from the last (re)start of the scanner at the earliest
+        self.started = self.heard_at = time.monotonic()
+        self._intervals: Dict[str, float] = dict.fromkeys(devices, default_interval)
+        self._last_seen: Dict[str, float] = {}
+        self._stalled_since: Optional[float] = None
+
+    def seen(self, device: str, now: Optional[float] = None):
+        """Record a frame from device"""
+        now = time.monotonic() if now is None else now
+        last = self._last_seen.get(device)
+        if last is not None:
+            gap = now - last
+            # A gap longer than the deadline is an outage, not the device's rhythm
+            if gap < self.deadline(device):
+                interval = self._intervals.get(device, self.default_interval)
+                self._intervals[device] = interval + (gap - interval) * INTERVAL_SMOOTHING
+        self._last_seen[device] = now
+        self.heard_at = now
+
+    def deadline(self, device: str) -> float:
+        return max(self.min_silence, self.factor * self._intervals.get(device, self.default_interval))
+
+    def stalled(self, now: float) -> bool:
+        return all(now - max(self._last_seen.get(device, self.started), self.started) > self.deadline(device)
+                   for device in self._intervals)
+
+    def silence(self, now: Optional[float] = None) -> float:
+        """Seconds since any device was heard (or since the watchdog started)"""
+        return (time.monotonic() if now is None else now) - self.heard_at
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            now = time.monotonic()
+            if self._stalled_since is not None and self.heard_at > self.started:
+                logger.info(f"Scanner recovered {now - self._stalled_since:.1f}s after it stalled "
+                            f"({self.restarts} restarts so far)")
+                self._stalled_since = None
+                self.backoff.reset()
+            if not self.stalled(now):
+                continue
+            if self._stalled_since is None:
+                self._stalled_since = now
+                logger.warning(f"No advertisement from any device for {self.silence(now):.1f}s, restarting the scanner")
+            else:
+                delay = self.backoff.next()
+                logger.warning(f"Scanner still silent after restarting, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            await self._restart()
+
+    async def _restart(self):
+        self.restarts += 1
+        metrics.SCANNER_RESTARTS.inc()
+        try:
+            if not await self.restart():
+                logger.error("Scanner restart failed")
+        except Exception as e:
+            logger.error(f"Error restarting scanner: {e}")
+        self.started = time.monotonic()
@@ -0,0 +1,313 @@
+"""
+Embedded append-only time-series store for decoded readings.
+
+Each device has an in-memory head block of array-backed columns: epoch
+milliseconds plus one float64 column per field (text fields are dictionary
+encoded, missing values are NaN). Full blocks are compressed (delta-of-delta
+varint timestamps, byte-granular Gorilla-style XOR floats, then zlib) and
+appended to a daily segment file, with a fixed-width time index for range
+lookups.
+"""
+import bisect
+import json
+import logging
+import math
+import os
+import struct
+import time
+import zlib
+from array import array
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# start_ms, end_ms, segment day (YYYYMMDD), offset, length
+INDEX_RECORD = struct.Struct('<qqIQI')
+FLOAT_BITS = struct.Struct('<d')
+INT_BITS = struct.Struct('<Q')
+REPEAT = 0xff  # Control byte for a value identical to the previous one
+NUMERIC = 'n'
+TEXT = 's'
+
+
+def _encode_varint(value: int, out: bytearray):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _decode_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _unzigzag(value: int) -> int:
+    return (value >> 1) ^ -(value & 1)
+
+
+def encode_timestamps(values: array, out: bytearray):
+    previous = previous_delta = 0
+    for value in values:
+        delta = value - previous
+        _encode_varint(_zigzag(delta - previous_delta), out)
+        previous, previous_delta = value, delta
+
+
+def decode_timestamps(buf: bytes, pos: int, count: int) -> Tuple[array, int]:
+    values = array('q')
+    previous = previous_delta = 0
+    for _ in range(count):
+        encoded, pos = _decode_varint(buf, pos)
+        previous_delta += _unzigzag(encoded)
+        previous += previous_delta
+        values.append(previous)
+    return values, pos
+
+
+def encode_floats(values: array, out: bytearray):
+    """XOR each value's bits with the previous value's and keep only the non-zero middle bytes"""
+    previous = 0
+    for value in values:
+        bits = INT_BITS.unpack(FLOAT_BITS.pack(value))[0]
+        xored = bits ^ previous
+        previous = bits
+        if not xored:
+            out.append(REPEAT)
+            continue
+        raw = xored.to_bytes(8, 'big')
+        lead = 8 - len(raw.lstrip(b'\0'))
+        trail = 8 - len(raw.rstrip(b'\0'))
+        # Control byte: count of zero bytes before and after the meaningful ones
+        out.append(lead << 4 | trail)
+        out += raw[lead:8 - trail]
+
+
+def decode_floats(buf: bytes, pos: int, count: int) -> Tuple[array, int]:
+    values = array('d')
+    previous = 0
+    for _ in range(count):
+        control = buf[pos]
+        pos += 1
+        if control != REPEAT:
+            lead, trail = control >> 4, control & 0x0f
+            width = 8 - lead - trail
+            previous ^= int.from_bytes(buf[pos:pos + width], 'big') << (8 * trail)
+            pos += width
+        values.append(FLOAT_BITS.unpack(INT_BITS.pack(previous))[0])
+    return values, pos
+
+
+class Block:
+    """Column-oriented rows of one device, either the live head or a decoded segment block"""
+
+    def __init__(self, fields: Optional[Dict[str, str]] = None):
+        self.timestamps = array('q')
+        self.fields: Dict[str, str] = dict(fields or {})
+        self.columns: Dict[str, array] = {name: array('d') for name in self.fields}
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    def add_field(self, name: str, kind: str):
+        self.fields[name] = kind
+        self.columns[name] = array('d', [math.nan]) * len(self.timestamps)
+
+    def encode(self) -> bytes:
+        header = json.dumps({'n': len(self), 'fields': list(self.fields.items())}).encode()
+        body = bytearray()
+        encode_timestamps(self.timestamps, body)
+        for name in self.fields:
+            encode_floats(self.columns[name], body)
+        return zlib.compress(header + b'\n' + bytes(body))
+
+    @classmethod
+    def decode(cls, blob: bytes) -> "Block":
+        raw = zlib.decompress(blob)
+        newline = raw.index(b'\n')
+        header = json.loads(raw[:newline])
+        block = cls(dict(header['fields']))
+        pos = newline + 1
+        block.timestamps, pos = decode_timestamps(raw, pos, header['n'])
+        for name in block.fields:
+            block.columns[name], pos = decode_floats(raw, pos, header['n'])
+        return block
+
+
+class DeviceSeries:
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.head = Block()
+        self.head_started = time.monotonic()
+        self.index: List[Tuple[int, int, int, int, int]] = []
+        self.index_starts: List[int] = []
+        index_path = os.path.join(directory, 'index.bin')
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                data = f.read()
+            usable = len(data) - len(data) % INDEX_RECORD.size
+            for record in INDEX_RECORD.iter_unpack(data[:usable]):
+                self.index.append(record)
+                self.index_starts.append(record[0])
+        self.symbols: List[str] = []
+        self.symbol_codes: Dict[str, int] = {}
+        symbols_path = os.path.join(directory, 'symbols.json')
+        if os.path.exists(symbols_path):
+            with open(symbols_path) as f:
+                self.symbols = json.load(f)
+            self.symbol_codes = {symbol: code for code, symbol in enumerate(self.symbols)}
+
+    def symbol_code(self, value: str) -> int:
+        code = self.symbol_codes.get(value)
+        if code is None:
+            code = self.symbol_codes[value] = len(self.symbols)
+            self.symbols.append(value)
+            with open(os.path.join(self.directory, 'symbols.json'), 'w') as f:
+                json.dump(self.symbols, f)
+        return code
+
+    def append(self, timestamp_ms: int, data: Dict[str, Any]):
+        head = self.head
+        for name, value in data.items():
+            if name == 'timestamp' or value is None or name in head.fields:
+                continue
+            is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            head.add_field(name, NUMERIC if is_number else TEXT)
+        head.timestamps.append(timestamp_ms)
+        for name, kind in head.fields.items():
+            value = data.get(name)
+            if value is None:
+                head.columns[name].append(math.nan)
+            elif kind == TEXT:
+                head.columns[name].append(float(self.symbol_code(str(value))))
+            else:
+                try:
+                    head.columns[name].append(float(value))
+                except (TypeError, ValueError):
+                    head.columns[name].append(math.nan)
+
+    def flush(self):
+        if not len(self.head):
+            return
+        blob = self.head.encode()
+        start, end = self.head.timestamps[0], self.head.timestamps[-1]
+        day = int(datetime.fromtimestamp(start / 1000, timezone.utc).strftime('%Y%m%d'))
+        with open(os.path.join(self.directory, f"{day}.seg"), 'ab') as f:
+            offset = f.tell()
+            f.write(blob)
+        record = (start, end, day, offset, len(blob))
+        with open(os.path.join(self.directory, 'index.bin'), 'ab') as f:
+            f.write(INDEX_RECORD.pack(*record))
+        position = bisect.bisect_right(self.index_starts, start)
+        self.index.insert(position, record)
+        self.index_starts.insert(position, start)
+        self.head = Block()
+        self.head_started = time.monotonic()
+
+    def blocks(self, start_ms: int, end_ms: int) -> Iterator[Block]:
+        """Flushed blocks overlapping [start_ms, end_ms], then the head"""
+        for start, end, day, offset, length in self.index[:bisect.bisect_right(self.index_starts, end_ms)]:
+            if end < start_ms:
+                continue
+            with open(os.path.join(self.directory, f"{day}.seg"), 'rb') as f:
+                f.seek(offset)
+                yield Block.decode(f.read(length))
+        if len(self.head):
+            yield self.head
+
+    def value(self, kind: str, raw: float) -> Any:
+        if math.isnan(raw):
+            return None
+        if kind == TEXT:
+            return self.symbols[int(raw)]
+        return raw
+
+
+class TimeSeriesStore:
+    def __init__(self, root: str, block_rows: int = 3600, flush_interval: float = 600.0):
+        self.root = root
+        self.block_rows = block_rows
+        self.flush_interval = flush_interval
+        self._series: Dict[str, DeviceSeries] = {}
+        os.makedirs(root, exist_ok=True)
+
+    def _device(self, device: str) -> DeviceSeries:
+        series = self._series.get(device)
+        if series is None:
+            series = self._series[device] = DeviceSeries(os.path.join(self.root, device))
+        return series
+
+    def devices(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name)))
+
+    def append(self, device: str, timestamp: float, data: Dict[str, Any]):
+        """Record one reading taken at timestamp (epoch seconds)"""
+        series = self._device(device)
+        series.append(int(timestamp * 1000), data)
+        if len(series.head) >= self.block_rows or time.monotonic() - series.head_started >= self.flush_interval:
+            series.flush()
+
+    def range_scan(self, device: str, start: float, end: float,
+                   fields: Optional[List[str]] = None) -> Iterator[Tuple[float, Dict[str, Any]]]:
+        """Yield (epoch seconds, {field: value}) for readings in [start, end]"""
+        series = self._device(device)
+        start_ms, end_ms = int(start * 1000), int(end * 1000)
+        for block in series.blocks(start_ms, end_ms):
+            names = [name for name in (fields or block.fields) if name in block.fields]
+            timestamps = block.timestamps
+            first = bisect.bisect_left(timestamps, start_ms)
+            last = bisect.bisect_right(timestamps, end_ms)
+            for row in range(first, last):
+                yield timestamps[row] / 1000, {
+                    name: series.value(block.fields[name], block.columns[name][row]) for name in names
+                }
+
+    def downsample(self, device: str, start: float, end: float, step: float,
+                   fields: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """Buckets of step seconds with min/max/mean/last per numeric field and last per text field"""
+        buckets: Dict[int, Dict[str, Any]] = {}
+        for timestamp, values in self.range_scan(device, start, end, fields):
+            bucket_start = int((timestamp - start) // step)
+            bucket = buckets.setdefault(bucket_start, {'count': 0, 'fields': {}})
+            bucket['count'] += 1
+            for name, value in values.items():
+                if value is None:
+                    continue
+                stats = bucket['fields'].get(name)
+                if isinstance(value, str):
+                    bucket['fields'][name] = {'last': value}
+                elif stats is None:
+                    bucket['fields'][name] = {'min': value, 'max': value, 'sum': value, 'count': 1, 'last': value}
+                else:
+                    stats['min'] = min(stats['min'], value)
+                    stats['max'] = max(stats['max'], value)
+                    stats['sum'] += value
+                    stats['count'] += 1
+                    stats['last'] = value
+        result = []
+        for bucket_start in sorted(buckets):
+            bucket = buckets[bucket_start]
+            for stats in bucket['fields'].values():
+                if 'sum' in stats:
+                    stats['mean'] = stats.pop('sum') / stats.pop('count')
+            result.append({'start': start + bucket_start * step, 'count': bucket['count'], 'fields': bucket['fields']})
+        return result
+
+    def flush(self):
+        for series in self._series.values():
+            series.flush()
+
+    def close(self):
+        self.flush()